@@ -0,0 +1,207 @@
+import os
+import pickle
+import sqlite3
+import time
+from typing import Any, Dict, List
+
+# Number of reads whose access times are kept in memory before they are written to the file.
+ACCESS_BATCH_SIZE = 1000
+# Fraction of max_size that the cache is reduced to when it is full, so that the next writes do not have to evict again.
+EVICT_TO = 0.9
+
+class DiskCache:
+    """
+    A persistent key-value cache stored in a local SQLite file.
+    Values can be any picklable object. When the total size of the stored values goes above max_size,
+    the least recently used entries are removed until it is down to 90% of max_size.
+    Reads are only marked as recent in the file in batches, when values are stored, and when the cache is closed.
+
+    Parameters
+    ----------
+    path : str
+        Path to the SQLite file. It is created if it does not exist.
+    max_size : int
+        The maximum total size of the stored values in bytes.
+    """
+
+    def __init__(
+            self,
+            path: str,
+            max_size: int = 1024**3
+    ) -> None:
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.max_size = max_size
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB, size INTEGER, last_access REAL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access)")
+        self.connection.commit()
+        # Running total of the stored value sizes, so that it does not have to be summed for every write.
+        self.total_size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        # Access times of the values read since they were last written to the file.
+        self.pending_access = {}
+
+    def get(
+            self,
+            key: str,
+            default: Any = None
+    ) -> Any:
+        """
+        Get a single value from the cache.
+
+        Parameters
+        ----------
+        key : str
+            The key of the value.
+        default : Any
+            Returned if the key is not in the cache.
+
+        Returns
+        -------
+        Any
+            The cached value, or default if it is not in the cache.
+        """
+
+        return self.get_many([key]).get(key, default)
+
+    def get_many(
+            self,
+            keys: List[str]
+    ) -> Dict[str, Any]:
+        """
+        Get several values from the cache at once. Marks every value found as recently used.
+
+        Parameters
+        ----------
+        keys : List[str]
+            The keys of the values.
+
+        Returns
+        -------
+        Dict[str, Any]
+            The cached values, with their keys as keys. Keys not in the cache are left out.
+        """
+
+        values = {}
+        # SQLite limits the number of parameters in a single statement.
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self.connection.execute(f"SELECT key, value FROM entries WHERE key IN ({placeholders})", chunk).fetchall()
+            for key, value in rows:
+                values[key] = pickle.loads(value)
+        now = time.time()
+        for key in values:
+            self.pending_access[key] = now
+        if len(self.pending_access) >= ACCESS_BATCH_SIZE:
+            self.__write_access()
+            self.connection.commit()
+        return values
+
+    def set(
+            self,
+            key: str,
+            value: Any
+    ) -> None:
+        """
+        Store a single value in the cache.
+
+        Parameters
+        ----------
+        key : str
+            The key of the value.
+        value : Any
+            The value to store. Must be picklable.
+        """
+
+        self.set_many({key: value})
+
+    def set_many(
+            self,
+            items: Dict[str, Any]
+    ) -> None:
+        """
+        Store several values in the cache at once, and evict the least recently used entries if the cache is full.
+
+        Parameters
+        ----------
+        items : Dict[str, Any]
+            The values to store, with their keys as keys. The values must be picklable.
+        """
+
+        if len(items) == 0: return
+        now = time.time()
+        rows = []
+        for key, value in items.items():
+            blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+            rows.append((key, blob, len(blob), now))
+            self.pending_access.pop(key, None)
+        # Values that are replaced no longer count towards the total size.
+        keys = list(items)
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            placeholders = ",".join("?" * len(chunk))
+            self.total_size -= self.connection.execute(f"SELECT COALESCE(SUM(size), 0) FROM entries WHERE key IN ({placeholders})", chunk).fetchone()[0]
+        self.total_size += sum(row[2] for row in rows)
+        self.__write_access()
+        self.connection.executemany("INSERT OR REPLACE INTO entries (key, value, size, last_access) VALUES (?, ?, ?, ?)", rows)
+        self.__evict()
+        self.connection.commit()
+
+    def clear(self) -> None:
+        """
+        Remove every entry from the cache.
+        """
+
+        self.connection.execute("DELETE FROM entries")
+        self.connection.commit()
+        self.total_size = 0
+        self.pending_access = {}
+
+    def size(self) -> int:
+        """
+        The total size of the stored values in bytes.
+
+        Returns
+        -------
+        int
+            The size in bytes.
+        """
+
+        return self.total_size
+
+    def close(self) -> None:
+        """
+        Write the pending access times, and close the connection to the SQLite file.
+        """
+
+        self.__write_access()
+        self.connection.commit()
+        self.connection.close()
+
+    def __write_access(self) -> None:
+        """
+        Write the access times of the values read since the last write, without committing them.
+        """
+
+        if len(self.pending_access) == 0: return
+        self.connection.executemany("UPDATE entries SET last_access = ? WHERE key = ?", [(now, key) for key, now in self.pending_access.items()])
+        self.pending_access = {}
+
+    def __evict(self) -> None:
+        """
+        Remove the least recently used entries until the cache is no larger than EVICT_TO times max_size, if it is larger than max_size.
+        """
+
+        if self.total_size <= self.max_size: return
+        excess = self.total_size - int(self.max_size * EVICT_TO)
+        removed = 0
+        keys = []
+        # The entries are read in order of the last_access index, and only until enough of them have been found.
+        for key, size in self.connection.execute("SELECT key, size FROM entries ORDER BY last_access"):
+            keys.append((key,))
+            removed += size
+            if removed >= excess: break
+        self.connection.executemany("DELETE FROM entries WHERE key = ?", keys)
+        self.total_size -= removed
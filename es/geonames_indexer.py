@@ -1,16 +1,41 @@
 import sys
+import os
+import re
+import json
+import argparse
+from itertools import chain
+from contextlib import ExitStack
+from multiprocessing import Pool
 from elasticsearch import Elasticsearch, helpers
+from datetime import datetime
 from tqdm import tqdm
 import csv
 
+# The ranking features are shared with the geoparser, which lives in the parent folder.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from features import geonames_features, hierarchy_key, SCHEMA_VERSION
+
 INDEX_NAME = "geonames_custom"
+# Names get two keyword subfields in addition to the text field: "keyword" for exact lookups, and "normalized" for lookups
+# that ignore capitalization and diacritics.
+NAME_FIELDS = {
+    "keyword": {"type": "keyword"},
+    "normalized": {"type": "keyword", "normalizer": "folded"}
+}
 INDEX_SETTINGS = {
+    "settings": {
+        "analysis": {
+            "normalizer": {
+                "folded": {"type": "custom", "filter": ["lowercase", "asciifolding"]}
+            }
+        }
+    },
     "mappings": {
         "properties": {
             "geonameid": {"type": "keyword"},
-            "name": {"type": "text"},
-            "asciiname": {"type": "text"},
-            "alternatenames": {"type": "text", "norms": False, "similarity": "boolean"},
+            "name": {"type": "text", "fields": NAME_FIELDS},
+            "asciiname": {"type": "text", "fields": NAME_FIELDS},
+            "alternatenames": {"type": "text", "norms": False, "similarity": "boolean", "fields": NAME_FIELDS},
             "coordinates": {"type": "geo_point"},
             "feature_class": {"type": "keyword"},
             "feature_code": {"type": "keyword"},
@@ -20,58 +45,304 @@ INDEX_SETTINGS = {
             "admin3_code": {"type": "keyword"},
             "admin4_code": {"type": "keyword"},
             "population": {"type": "long"},
+            "pop_score": {"type": "float"},
+            "alt_names_count": {"type": "integer"},
+            "alt_names_score": {"type": "float"},
             "modification_date": {"type": "date", "format": "date"}
+        },
+        "_meta": {"schema_version": SCHEMA_VERSION}
+    }
+}
+
+# Small index with the administrative entries (PCLI, ADM1 and ADM2), used by the geoparser to find the ancestors of candidates.
+# Each document holds all entries with the same place in the administrative hierarchy, under the id "<country_code>.<admin1_code>.<admin2_code>".
+ADMIN_INDEX_NAME = "geonames_admin"
+ADMIN_INDEX_SETTINGS = {
+    "mappings": {
+        "properties": {
+            "entries": {"type": "object", "enabled": False}
         }
     }
 }
+ADMIN_FEATURE_CODES = ["PCLI", "ADM1", "ADM2"]
+
+# Index settings used while bulk loading. Refreshing and replicating the index during the load only slows it down.
+BULK_SETTINGS = {"refresh_interval": "-1", "number_of_replicas": 0}
+# Elasticsearch's defaults for the same settings.
+DEFAULT_SETTINGS = {"refresh_interval": "1s", "number_of_replicas": 1}
+
+# Size of the parts of the file that are handed out to the workers, and the granularity of the checkpoints.
+SEGMENT_SIZE = 16 * 1024**2
+
+# Names of the daily files published by GeoNames, e.g., "modifications-2024-01-31.txt" and "deletes-2024-01-31.txt".
+DELTA_FILE = re.compile(r"(modifications|deletes)-(\d{4}-\d{2}-\d{2})\.txt")
+
+def parse_geonames_row(row):
+    coords = f"{row[4]},{row[5]}"
+    alt_names = list(set(row[3].split(",")))
+    
+    if str(row[0]) == "6252001":
+        alt_names.append("US")
+        alt_names.append("U.S.")
+    if str(row[0]) == "239880":
+        alt_names.append("C.A.R.")
+    
+    doc = {
+        "geonameid": row[0],
+        "name": row[1],
+        "asciiname": row[2],
+        "alternatenames": alt_names,
+        "coordinates": coords,
+        "feature_class" : row[6],
+        "feature_code" : row[7],
+        "country_code" : row[8],
+        "admin1_code" : row[10],
+        "admin2_code" : row[11],
+        "admin3_code" : row[12],
+        "admin4_code" : row[13],
+        "population": row[14],
+        "modification_date": row[18],
+    }
+    doc.update(geonames_features(doc))
+    return {
+        "_index": INDEX_NAME,
+        "_id": row[0],
+        "_source": doc
+    }
 
-def parse_geonames_data(reader):
-    for row in tqdm(reader, total=12760304):
+def parse_geonames_data(reader, progress=True):
+    for row in tqdm(reader, total=12760304, disable=not progress):
         try:
-            coords = f"{row[4]},{row[5]}"
-            alt_names = list(set(row[3].split(",")))
-            
-            if str(row[0]) == "6252001":
-                alt_names.append("US")
-                alt_names.append("U.S.")
-            if str(row[0]) == "239880":
-                alt_names.append("C.A.R.")
-            
-            doc = {
-                "geonameid": row[0],
-                "name": row[1],
-                "asciiname": row[2],
-                "alternatenames": alt_names,
-                "coordinates": coords,
-                "feature_class" : row[6],
-                "feature_code" : row[7],
-                "country_code" : row[8],
-                "admin1_code" : row[10],
-                "admin2_code" : row[11],
-                "admin3_code" : row[12],
-                "admin4_code" : row[13],
-                "population": row[14],
-                "modification_date": row[18],
-            }
-            yield {
-                "_index": INDEX_NAME,
-                "_id": row[0],
-                "_source": doc
-            }
+            yield parse_geonames_row(row)
         except Exception as e:
             print(e, row)
 
+def split_segments(file_path, segment_size=SEGMENT_SIZE):
+    """
+    Split a file into segments of roughly segment_size bytes, that always start and end at a line break.
+    """
 
-if __name__ == "__main__":
-    es = Elasticsearch("http://localhost:9200")
+    segments = []
+    file_size = os.path.getsize(file_path)
+    with open(file_path, "rb") as file:
+        start = 0
+        while start < file_size:
+            file.seek(min(start + segment_size, file_size))
+            file.readline()
+            end = min(file.tell(), file_size)
+            segments.append((start, end))
+            start = end
+    return segments
+
+def read_segment(file_path, start, end):
+    """
+    Yield the rows of a GeoNames file between two byte offsets.
+    """
+
+    def lines(file):
+        while file.tell() < end:
+            line = file.readline()
+            if not line: return
+            yield line.decode("utf-8")
+
+    with open(file_path, "rb") as file:
+        file.seek(start)
+        yield from csv.reader(lines(file), delimiter="\t")
+
+# Elasticsearch client of a worker process, created by __init_worker().
+WORKER_ES = None
+
+def __init_worker(url):
+    global WORKER_ES
+    WORKER_ES = Elasticsearch(url)
+
+def __index_segment(args):
+    file_path, start, end, chunk_size = args
+    latest_date = ""
+    def actions():
+        nonlocal latest_date
+        for action in parse_geonames_data(read_segment(file_path, start, end), progress=False):
+            latest_date = max(latest_date, action["_source"]["modification_date"])
+            yield action
+    helpers.bulk(WORKER_ES, actions(), chunk_size=chunk_size)
+    return start, end, latest_date
+
+def check_schema(es):
+    """
+    Make sure that an existing index was created with the current mapping and features, as an index created with an older version
+    is missing fields that the geoparser searches and ranks by, and would silently return no candidates.
+    """
+
+    meta = es.indices.get_mapping(index=INDEX_NAME)[INDEX_NAME]["mappings"].get("_meta", {})
+    if meta.get("schema_version") != SCHEMA_VERSION:
+        raise Exception(f"The \"{INDEX_NAME}\" index has schema version {meta.get('schema_version')} instead of {SCHEMA_VERSION}, reindex required: delete the index and index the full file again")
+
+def index_geonames(file_path, url="http://localhost:9200", workers=4, chunk_size=500, segment_size=SEGMENT_SIZE, checkpoint_path=None):
+    """
+    Index a GeoNames file with several worker processes, that each parse and send their own segments of the file.
+    Finished segments are stored in a checkpoint file, so that an interrupted run continues where it stopped when it is started again.
+    Refreshing and replicas are turned off during the load, and restored when it is done.
+    The latest modification date in the file is stored on the index, so that apply_geonames_deltas() only applies changes made after it.
+    """
+
+    es = Elasticsearch(url)
     if not es.indices.exists(INDEX_NAME):
         es.indices.create(index=INDEX_NAME, body=INDEX_SETTINGS)
-    if len(sys.argv) != 2:
-        print(f"Invalid number of arguments. Script takes 1 argument but {len(sys.argv)-1} were provided.")
-        exit()
-    file = open(sys.argv[1], "rt", encoding="utf-8")
-    
-    reader = csv.reader(file, delimiter="\t")
-    actions = parse_geonames_data(reader)
-    helpers.bulk(es, actions, chunk_size=500)
+    check_schema(es)
+    if checkpoint_path is None: checkpoint_path = file_path + ".checkpoint.json"
+
+    # The checkpoint is only used if it was made from the same version of the file.
+    file_stamp = [os.path.getsize(file_path), os.path.getmtime(file_path)]
+    checkpoint = None
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path, "rt") as file:
+            checkpoint = json.load(file)
+        if checkpoint["file_stamp"] != file_stamp or checkpoint["segment_size"] != segment_size: checkpoint = None
+    if checkpoint is None:
+        index_settings = es.indices.get_settings(index=INDEX_NAME)[INDEX_NAME]["settings"]["index"]
+        settings = {
+            "refresh_interval": index_settings.get("refresh_interval", DEFAULT_SETTINGS["refresh_interval"]),
+            "number_of_replicas": int(index_settings.get("number_of_replicas", DEFAULT_SETTINGS["number_of_replicas"]))
+        }
+        # An earlier load that crashed, or whose checkpoint was removed, can have left the bulk settings on the index, and those should not be restored.
+        if settings == BULK_SETTINGS: settings = dict(DEFAULT_SETTINGS)
+        checkpoint = {
+            "file_stamp": file_stamp,
+            "segment_size": segment_size,
+            # The settings to restore after the load. Stored here so that they are not lost if the load is interrupted.
+            "settings": settings,
+            "done": []
+        }
+    else:
+        print(f"Resuming from checkpoint with {len(checkpoint['done'])} finished segments")
+
+    def write_checkpoint():
+        with open(checkpoint_path + ".tmp", "wt") as file:
+            json.dump(checkpoint, file)
+        os.replace(checkpoint_path + ".tmp", checkpoint_path)
+    write_checkpoint()
+
+    done = {start for start, _, _ in checkpoint["done"]}
+    segments = [(start, end) for start, end in split_segments(file_path, segment_size) if start not in done]
+    es.indices.put_settings(index=INDEX_NAME, body={"index": BULK_SETTINGS})
+    with tqdm(total=file_stamp[0], initial=sum(end - start for start, end, _ in checkpoint["done"]), unit="B", unit_scale=True) as progress:
+        with Pool(workers, initializer=__init_worker, initargs=(url,)) as pool:
+            for start, end, latest_date in pool.imap_unordered(__index_segment, [(file_path, start, end, chunk_size) for start, end in segments]):
+                checkpoint["done"].append([start, end, latest_date])
+                write_checkpoint()
+                progress.update(end - start)
+
+    es.indices.put_settings(index=INDEX_NAME, body={"index": checkpoint["settings"]})
+    es.indices.refresh(index=INDEX_NAME)
+    # Store a new version on the index, so that the geoparser's gazetteer cache knows that the data has changed.
+    delta_date = max((latest_date for _, _, latest_date in checkpoint["done"]), default="")
+    es.indices.put_mapping(index=INDEX_NAME, body={"_meta": {"schema_version": SCHEMA_VERSION, "version": datetime.now().isoformat(), "delta_date": delta_date}})
+    index_admin_entries(es)
+    os.remove(checkpoint_path)
+
+def apply_geonames_deltas(directory, url="http://localhost:9200", chunk_size=500):
+    """
+    Apply the daily GeoNames modifications and deletes files in a directory to an existing index.
+    Modified entries are indexed by their geonameid, replacing any previous version, and deleted entries are removed.
+    The date of the last applied files is stored on the index, and files from that date or earlier are skipped, so running it again has no effect.
+    """
+
+    es = Elasticsearch(url)
+    check_schema(es)
+    meta = es.indices.get_mapping(index=INDEX_NAME)[INDEX_NAME]["mappings"].get("_meta", {})
+    last_date = meta.get("delta_date", "")
+
+    delta_files = {}
+    for file_name in os.listdir(directory):
+        match = DELTA_FILE.fullmatch(file_name)
+        if match is None: continue
+        delta_files.setdefault(match.group(2), {})[match.group(1)] = os.path.join(directory, file_name)
+
+    applied = 0
+    for date in sorted(delta_files):
+        if date <= last_date: continue
+        print(f"Applying GeoNames changes from {date}")
+        paths = delta_files[date]
+        with ExitStack() as stack:
+            actions = []
+            if "modifications" in paths:
+                file = stack.enter_context(open(paths["modifications"], "rt", encoding="utf-8"))
+                actions.append(parse_geonames_data(csv.reader(file, delimiter="\t"), progress=False))
+            if "deletes" in paths:
+                # Deletes are applied after modifications, in case an entry was changed and then deleted on the same day.
+                file = stack.enter_context(open(paths["deletes"], "rt", encoding="utf-8"))
+                actions.append({"_op_type": "delete", "_index": INDEX_NAME, "_id": row[0]} for row in csv.reader(file, delimiter="\t") if len(row) != 0)
+            # Entries that are already missing when they are deleted are not an error, but every other failed action is.
+            errors = []
+            for ok, item in helpers.streaming_bulk(es, chain(*actions), chunk_size=chunk_size, raise_on_error=False):
+                if ok:
+                    applied += 1
+                    continue
+                op_type, result = next(iter(item.items()))
+                if op_type == "delete" and result.get("status") == 404: continue
+                errors.append(item)
+            if len(errors) != 0:
+                raise helpers.BulkIndexError(f"{len(errors)} GeoNames changes from {date} could not be applied", errors)
+        # The date is stored after every day, so that an interrupted run continues from the first day that was not applied.
+        es.indices.put_mapping(index=INDEX_NAME, body={"_meta": {"schema_version": SCHEMA_VERSION, "version": datetime.now().isoformat(), "delta_date": date}})
+        last_date = date
+    # The admin index only needs to be rebuilt if an entry was actually changed.
+    if applied == 0: return
     es.indices.refresh(index=INDEX_NAME)
+    index_admin_entries(es)
+
+def index_admin_entries(es):
+    """
+    Rebuild the admin index from the administrative entries in the GeoNames index.
+    GeoNames can have more than one entry with the same place in the hierarchy, so they are grouped into one document per place.
+    The admin index name is an alias, which is only moved to the rebuilt index once it is complete.
+    """
+
+    check_schema(es)
+    entries = {}
+    query = {"query": {"bool": {"filter": [{"terms": {"feature_code": ADMIN_FEATURE_CODES}}]}}}
+    for hit in helpers.scan(es, query=query, index=INDEX_NAME):
+        entries.setdefault(".".join(hierarchy_key(hit["_source"])), []).append(hit["_source"])
+
+    # The entries are indexed under a new versioned name, and the admin index name is an alias that is moved to it once it is complete,
+    # so that the geoparser can keep looking up entries in the old index while the new one is built.
+    index_name = f"{ADMIN_INDEX_NAME}_{datetime.now().strftime('%Y%m%d%H%M%S%f')}"
+    es.indices.create(index=index_name, body=ADMIN_INDEX_SETTINGS)
+    helpers.bulk(es, ({"_index": index_name, "_id": id, "_source": {"entries": key_entries}} for id, key_entries in entries.items()))
+    es.indices.refresh(index=index_name)
+    # Store a version on the index, so that the geoparser's gazetteer cache knows that the data has changed.
+    es.indices.put_mapping(index=index_name, body={"_meta": {"version": datetime.now().isoformat()}})
+
+    actions = [{"add": {"index": index_name, "alias": ADMIN_INDEX_NAME}}]
+    old_indices = []
+    if es.indices.exists_alias(name=ADMIN_INDEX_NAME):
+        old_indices = list(es.indices.get_alias(name=ADMIN_INDEX_NAME))
+        actions = [{"remove": {"index": old_index, "alias": ADMIN_INDEX_NAME}} for old_index in old_indices] + actions
+    elif es.indices.exists(ADMIN_INDEX_NAME):
+        # An admin index from before the alias was used has the alias' name, and is removed in the same atomic update.
+        actions = [{"remove_index": {"index": ADMIN_INDEX_NAME}}] + actions
+    es.indices.update_aliases(body={"actions": actions})
+    for old_index in old_indices:
+        es.indices.delete(index=old_index)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Index the GeoNames \"allCountries.txt\" file in Elasticsearch.")
+    parser.add_argument("file_path", nargs="?", help="Path to the GeoNames file, or with --delta, the directory with the daily modifications and deletes files.")
+    parser.add_argument("--delta", action="store_true", help="Apply the daily modifications and deletes files to the existing index instead of indexing the full file.")
+    parser.add_argument("--admin", action="store_true", help="Only rebuild the admin index from the existing GeoNames index.")
+    parser.add_argument("--url", default="http://localhost:9200", help="Url of the Elasticsearch instance.")
+    parser.add_argument("--workers", type=int, default=4, help="Number of worker processes that parse and send documents.")
+    parser.add_argument("--chunk-size", type=int, default=500, help="Number of documents in each bulk request.")
+    parser.add_argument("--segment-size", type=int, default=SEGMENT_SIZE, help="Size in bytes of the file segments handed to the workers. Progress is checkpointed after each segment.")
+    parser.add_argument("--checkpoint", default=None, help="Path to the checkpoint file. Defaults to the file path with \".checkpoint.json\" appended.")
+    args = parser.parse_args()
+    if args.admin:
+        index_admin_entries(Elasticsearch(args.url))
+        exit()
+    if args.file_path is None:
+        parser.error("file_path is required unless --admin is used")
+    if args.delta:
+        apply_geonames_deltas(args.file_path, args.url, args.chunk_size)
+        exit()
+    index_geonames(args.file_path, args.url, args.workers, args.chunk_size, args.segment_size, args.checkpoint)
@@ -1,20 +1,50 @@
 from elasticsearch import Elasticsearch, helpers
+from datetime import datetime
+from multiprocessing import Pool
+from tqdm import tqdm
 import xml.etree.ElementTree as et
+import argparse
+import os
+import re
 import sys
 
+# The ranking features are shared with the geoparser, which lives in the parent folder.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from features import stedsnavn_features, SCHEMA_VERSION
+
 
 INDEX_NAME = "stedsnavn"
+# Names get two keyword subfields in addition to the text field: "keyword" for exact lookups, and "normalized" for lookups
+# that ignore capitalization and diacritics.
+NAME_FIELDS = {
+    "keyword": {"type": "keyword"},
+    "normalized": {"type": "keyword", "normalizer": "folded"}
+}
 INDEX_SETTINGS = {
+    "settings": {
+        "analysis": {
+            "normalizer": {
+                "folded": {"type": "custom", "filter": ["lowercase", "asciifolding"]}
+            }
+        }
+    },
     "mappings": {
         "properties": {
             "stedsnavnid": {"type": "keyword"},
-            "name": {"type": "text"},
+            "name": {"type": "text", "fields": NAME_FIELDS},
             "name_object_main_group": {"type": "text"},
             "name_object_group": {"type": "text"},
             "name_object_type": {"type": "text"},
-            "alternatenames": {"type": "text", "norms": False, "similarity": "boolean"},
+            "alternatenames": {"type": "text", "norms": False, "similarity": "boolean", "fields": NAME_FIELDS},
             "coordinates": {"type": "geo_point"},
-        }
+            "asciiname": {"type": "text", "fields": NAME_FIELDS},
+            "admin1_code": {"type": "keyword"},
+            "admin2_code": {"type": "keyword"},
+            "pop_score": {"type": "float"},
+            "alt_names_count": {"type": "integer"},
+            "alt_names_score": {"type": "float"},
+        },
+        "_meta": {"schema_version": SCHEMA_VERSION}
     }
 }
 
@@ -24,138 +54,286 @@ NS = {
     "gml": "{http://www.opengis.net/gml/3.2}"
 }
 
-def parse_stedsnavn_data(reader):
+STED = NS["app"] + "Sted"
+STEDSNAVN = NS["app"] + "Stedsnavn"
+SKRIVEMATE = NS["app"] + "Skrivemåte"
+KOMMUNE = NS["app"] + "Kommune"
+ADMIN_FIELDS = [NS["app"] + "fylkesnummer", NS["app"] + "fylkesnavn", NS["app"] + "kommunenummer", NS["app"] + "kommunenavn"]
+
+# Approximate size of the parts of the file that are handed out to the workers.
+SEGMENT_SIZE = 16 * 1024**2
+# Size of the blocks that the file is read in.
+BLOCK_SIZE = 1024**2
+
+def parse_sted(element):
+    id = element.attrib[NS["gml"] + "id"][5:]
+
+    # Find names and administrative divisions in a single pass over the element.
+    names = []
+    admin_codes = [] # [(admin1_code, admin2_code), ...]
+    admin_names = [] # [(admin1_name, admin2_name), ...] Index in admin_codes matches admin_names
+    placename_count = 0
+    for child in element.iter():
+        if child.tag == STEDSNAVN:
+            placename_count += 1
+            way_of_writing_count = 0
+            for way_of_writing in child.iter(SKRIVEMATE):
+                way_of_writing_count += 1
+                name = way_of_writing.find(NS["app"] + "langnavn").text
+                priority = True if way_of_writing.find(NS["app"] + "prioritertSkrivemåte").text == "true" else False
+                names.append({
+                    "name": name,
+                    "priority": priority
+                })
+            if way_of_writing_count == 0:
+                raise Exception(f"Failed to get \"way of writing\" data for entry: {id}")
+        elif child.tag == KOMMUNE:
+            fields = {field: [] for field in ADMIN_FIELDS}
+            for admin_child in child.iter():
+                if admin_child.tag in fields: fields[admin_child.tag].append(admin_child.text)
+            admin1_code, admin1_name, admin2_code, admin2_name = [fields[field] for field in ADMIN_FIELDS]
+            if len(admin1_code) > 1:
+                raise Exception(f"Found more than one admin1 code for Kommune in entry: {id}")
+            if len(admin1_name) > 1:
+                raise Exception(f"Found more than one admin1 name for Kommune in entry: {id}")
+            if len(admin2_code) > 1:
+                raise Exception(f"Found more than one admin2 code for Kommune in entry: {id}")
+            if len(admin2_name) > 1:
+                raise Exception(f"Found more than one admin2 navn for Kommune in entry: {id}")
+            admin_codes.append((admin1_code[0], admin2_code[0]))
+            admin_names.append((admin1_name[0], admin2_name[0]))
+    if placename_count == 0:
+        raise Exception(f"Failed to get placename data for entry: {id}")
+
+    entry_name = ""
+    alternate_names = []
+    for name in names:
+        if name["name"] in alternate_names: continue
+        if not entry_name and (name["priority"] or len(names) == 1): entry_name = name["name"]
+        else: alternate_names.append(name["name"])
+
+    # Need this, because sometimes no name is set to have priority true
+    if not entry_name:
+        entry_name = alternate_names[0]
+        alternate_names = alternate_names[1:]
+
+    # Find coordinates
+    coordinates = ""
+    position_element = element.find(NS["app"] + "posisjon")
+    if position_element is None:
+        raise Exception(f"Failed to get position data for entry: {id}")
+    type = position_element[0].tag
+    if type == NS["gml"] + "Point":
+        coordinates = ",".join(next(position_element.iter(NS["gml"] + "pos")).text.split())
+    elif type == NS["gml"] + "MultiPoint":
+        coordinates = ",".join(next(position_element.iter(NS["gml"] + "pos")).text.split())
+    elif type == NS["gml"] + "LineString":
+        # Seems to represent things such as road and tunnel segments
+        # For now we will simply select the first set of coordinates in the position list,
+        # as it seems like this indicates the start of the place in question
+        pos_list = next(position_element.iter(NS["gml"] + "posList"))
+        coordinates = ",".join(pos_list.text.split()[:2])
+    elif type == NS["gml"] + "MultiCurve":
+        # Seems to be primarily used for roads?
+        # Just select the starting position in one of the position lists for now.
+        pos_list = next(position_element.iter(NS["gml"] + "posList"))
+        coordinates = ",".join(pos_list.text.split()[:2])
+    elif type == NS["gml"] + "Polygon":
+        # Seems to concern geographical areas, such as seas.
+        # TODO: This just selects an element on the polygon atm.
+        # A better solution would find the centroid of the polygon, and use that as a reference point.
+        pos_list = next(position_element.iter(NS["gml"] + "posList"))
+        coordinates = ",".join(pos_list.text.split()[:2])
+    else:
+        raise Exception(f"No handle for position type: {type}")
+
+    name_object_main_group = element.find(NS["app"] + "navneobjekthovedgruppe")
+    name_object_group = element.find(NS["app"] + "navneobjektgruppe")
+    name_object_type = element.find(NS["app"] + "navneobjekttype")
+    if name_object_main_group is None or name_object_group is None or name_object_type is None:
+        raise Exception(f"Failed to get type data for entry: {id}")
+
+    doc = {
+        "stedsnavnid": id,
+        "name": entry_name,
+        "name_object_main_group": name_object_main_group.text,
+        "name_object_group": name_object_group.text,
+        "name_object_type": name_object_type.text,
+        "admin_codes": admin_codes,
+        "admin_names": admin_names,
+        "alternatenames": alternate_names,
+        "coordinates": coordinates
+    }
+    doc.update(stedsnavn_features(doc))
+    return {
+        "_index": INDEX_NAME,
+        "_id": id,
+        "_source": doc
+    }
+
+def parse_stedsnavn_data(reader, progress=True):
     i = 0
     for _, element in reader:
+        # Ignore any line except the root place element
+        if element.tag != STED:
+            continue
+
+        i += 1
+        if progress and i % 10000 == 0:
+            total = 1056214 # The total in question was from data taken in march 2024
+            print(f"Indexing element: {i}/{total}", end="\r")
+
         try:
-            # Ignore any line except the root place element
-            if element.tag != NS["app"] + "Sted":
+            yield parse_sted(element)
+        except Exception as e:
+            print(f"\n{e}")
+        finally:
+            element.clear() # Free up memory, also for entries that failed to parse
+
+def read_header(file_path):
+    """
+    Find the start tag of the root element in a GML file, and the name of the elements below it that hold the Sted elements, e.g., "wfs:member".
+    Returns the start tag, the name of the root element, the name of the elements holding the Sted elements, and the position of the first of them.
+    """
+
+    with open(file_path, "rb") as file:
+        head = file.read(BLOCK_SIZE)
+    # Declarations, comments, and end tags are skipped, so the first tag is the root element.
+    tags = list(re.finditer(rb"<([^?!/\s>]+)[^>]*>", head))
+    root = tags[0]
+    for i, tag in enumerate(tags):
+        if tag.group(1).split(b":")[-1] == b"Sted":
+            child = tags[max(i - 1, 1)]
+            return root.group(0), root.group(1), child.group(1), child.start()
+    return root.group(0), root.group(1), None, None
+
+def __find_tag(file, name, position, end):
+    """
+    Find the position of the next start tag with the given name in a file, between position and end.
+    Returns end if there is none.
+    """
+
+    token = b"<" + name
+    overlap = len(token) + 1
+    while position < end:
+        file.seek(position)
+        block = file.read(min(BLOCK_SIZE, end - position) + overlap)
+        for match in re.finditer(re.escape(token) + rb"[\s>/]", block):
+            if position + match.start() < end: return position + match.start()
+        position += BLOCK_SIZE
+    return end
+
+def split_segments(file_path, segment_size=SEGMENT_SIZE):
+    """
+    Split a GML file into segments of roughly segment_size bytes, that each hold a whole number of the root element's children.
+    """
+
+    _, root_name, child_name, start = read_header(file_path)
+    if child_name is None: return []
+    file_size = os.path.getsize(file_path)
+    with open(file_path, "rb") as file:
+        # The segments end where the root element is closed.
+        file.seek(max(file_size - BLOCK_SIZE, 0))
+        tail = file.read()
+        end = file_size - len(tail) + tail.rfind(b"</" + root_name)
+        segments = []
+        while start < end:
+            segment_end = __find_tag(file, child_name, min(start + segment_size, end), end)
+            segments.append((start, segment_end))
+            start = segment_end
+    return segments
+
+def read_segment(file_path, start=None, end=None):
+    """
+    Yield ("end", element) pairs for the elements of a GML file, in the same way as iterparse().
+    If start and end are given, only the elements of that segment are parsed, as returned by split_segments().
+    The elements directly below the root are removed from it once they have been yielded, so that memory does not grow with the size of the file.
+    """
+
+    root_tag, root_name, _, first = read_header(file_path)
+    if start is None:
+        start, end = 0, os.path.getsize(file_path)
+        prefix, suffix = b"", b""
+    else:
+        # The segment is wrapped in a copy of the root element, so that it has the namespace declarations of the file.
+        prefix, suffix = b"<?xml version=\"1.0\" encoding=\"utf-8\"?>" + root_tag, b"</" + root_name + b">"
+
+    parser = et.XMLPullParser(events=("start", "end"))
+    parser.feed(prefix)
+    root = None
+    depth = 0
+    def events():
+        nonlocal root, depth
+        for event, element in parser.read_events():
+            if event == "start":
+                if root is None: root = element
+                depth += 1
                 continue
+            depth -= 1
+            yield event, element
+            if depth == 1: root.clear()
 
-            i += 1
-            if i % 10000 == 0:
-                total = 1056214 # The total in question was from data taken in march 2024
-                print(f"Indexing element: {i}/{total}", end="\r")
-
-
-            id = element.attrib[NS["gml"] + "id"][5:]
-
-            # Find names
-            names = []
-            placename_list = element.findall(".//" + NS["app"] + "Stedsnavn")
-            if len(placename_list) == 0:
-                raise Exception(f"Failed to get placename data for entry: {id}")
-            for placename in placename_list:
-                way_of_writing_list = placename.findall(".//" + NS["app"] + "Skrivemåte")
-                if len(way_of_writing_list) == 0:
-                    raise Exception(f"Failed to get \"way of writing\" data for entry: {id}")
-                for way_of_writing in way_of_writing_list:
-                    name = way_of_writing.find(NS["app"] + "langnavn").text
-                    priority = True if way_of_writing.find(NS["app"] + "prioritertSkrivemåte").text == "true" else False
-                    names.append({
-                        "name": name,
-                        "priority": priority
-                    })
-
-            entry_name = ""
-            alternate_names = []
-            for name in names:
-                if name["name"] in alternate_names: continue
-                if not entry_name and (name["priority"] or len(names) == 1): entry_name = name["name"]
-                else: alternate_names.append(name["name"])
-            
-            # Need this, because sometimes no name is set to have priority true
-            if not entry_name:
-                entry_name = alternate_names[0]
-                alternate_names = alternate_names[1:]
-
-            # Administrative divisions
-            admin_codes = [] # [(admin1_code, admin2_code), ...]
-            admin_names = [] # [(admin1_name, admin2_name), ...] Index in admin_codes matches admin_names
-            admins_list = element.findall(".//" + NS["app"] + "Kommune")
-            for admin in admins_list:
-                admin1_code = admin.findall(".//" + NS["app"] + "fylkesnummer")
-                if len(admin1_code) > 1:
-                    raise Exception(f"Found more than one admin1 code for Kommune in entry: {id}")
-                admin1_name = admin.findall(".//" + NS["app"] + "fylkesnavn")
-                if len(admin1_name) > 1:
-                    raise Exception(f"Found more than one admin1 name for Kommune in entry: {id}")
-                admin2_code = admin.findall(".//" + NS["app"] + "kommunenummer")
-                if len(admin2_code) > 1:
-                    raise Exception(f"Found more than one admin2 code for Kommune in entry: {id}")
-                admin2_name = admin.findall(".//" + NS["app"] + "kommunenavn")
-                if len(admin2_name) > 1:
-                    raise Exception(f"Found more than one admin2 navn for Kommune in entry: {id}")
-                admin_codes.append((admin1_code[0].text, admin2_code[0].text))
-                admin_names.append((admin1_name[0].text, admin2_name[0].text))
-
-
-            # Find coordinates
-            coordinates = ""
-            position_element = element.find(NS["app"] + "posisjon")
-            if position_element is None:
-                raise Exception(f"Failed to get position data for entry: {id}")
-            type = list(position_element)[0].tag
-            if type == NS["gml"] + "Point":
-                coordinates = ",".join(position_element.find(".//" + NS["gml"] + "pos").text.split())
-            elif type == NS["gml"] + "MultiPoint":
-                positions = position_element.findall(".//" + NS["gml"] + "pos")
-                coordinates = ",".join(positions[0].text.split())
-            elif type == NS["gml"] + "LineString":
-                # Seems to represent things such as road and tunnel segments
-                # For now we will simply select the first set of coordinates in the position list,
-                # as it seems like this indicates the start of the place in question
-                pos_list = position_element.find(".//" + NS["gml"] + "posList")
-                coordinates = ",".join(pos_list.text.split()[:2])
-            elif type == NS["gml"] + "MultiCurve":
-                # Seems to be primarily used for roads?
-                # Just select the starting position in one of the position lists for now.
-                pos_list = position_element.find(".//" + NS["gml"] + "posList")
-                coordinates = ",".join(pos_list.text.split()[:2])
-            elif type == NS["gml"] + "Polygon":
-                # Seems to concern geographical areas, such as seas.
-                # TODO: This just selects an element on the polygon atm.
-                # A better solution would find the centroid of the polygon, and use that as a reference point.
-                pos_list = position_element.find(".//" + NS["gml"] + "posList")
-                coordinates = ",".join(pos_list.text.split()[:2])
-            else:
-                raise Exception(f"No handle for position type: {type}")
-            
-            name_object_main_group = element.find(NS["app"] + "navneobjekthovedgruppe")
-            name_object_group = element.find(NS["app"] + "navneobjektgruppe")
-            name_object_type = element.find(NS["app"] + "navneobjekttype")
-            if name_object_main_group is None or name_object_group is None or name_object_type is None:
-                raise Exception(f"Failed to get type data for entry: {id}")
-            
-            element.clear() # Free up memory
-            yield {
-                "_index": INDEX_NAME,
-                "_id": id,
-                "_source": {
-                    "stedsnavnid": id,
-                    "name": entry_name,
-                    "name_object_main_group": name_object_main_group.text,
-                    "name_object_group": name_object_group.text,
-                    "name_object_type": name_object_type.text,
-                    "admin_codes": admin_codes,
-                    "admin_names": admin_names,
-                    "alternatenames": alternate_names,
-                    "coordinates": coordinates
-                }
-            }
-        except Exception as e:
-            print("\n"+ e)
+    with open(file_path, "rb") as file:
+        file.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            block = file.read(min(BLOCK_SIZE, remaining))
+            if not block: break
+            remaining -= len(block)
+            parser.feed(block)
+            yield from events()
+    parser.feed(suffix)
+    yield from events()
+    parser.close()
 
-if __name__ == "__main__":
-    es = Elasticsearch("http://localhost:9200")
+# Elasticsearch client of a worker process, created by __init_worker().
+WORKER_ES = None
+
+def __init_worker(url):
+    global WORKER_ES
+    WORKER_ES = Elasticsearch(url)
+
+def __index_segment(args):
+    file_path, start, end, chunk_size = args
+    helpers.bulk(WORKER_ES, parse_stedsnavn_data(read_segment(file_path, start, end), progress=False), chunk_size=chunk_size)
+    return start, end
+
+def check_schema(es):
+    """
+    Make sure that an existing index was created with the current mapping and features, as an index created with an older version
+    is missing fields that the geoparser searches and ranks by, and would silently return no candidates.
+    """
+
+    meta = es.indices.get_mapping(index=INDEX_NAME)[INDEX_NAME]["mappings"].get("_meta", {})
+    if meta.get("schema_version") != SCHEMA_VERSION:
+        raise Exception(f"The \"{INDEX_NAME}\" index has schema version {meta.get('schema_version')} instead of {SCHEMA_VERSION}, reindex required: delete the index and index the full file again")
+
+def index_stedsnavn(file_path, url="http://localhost:9200", workers=4, chunk_size=500, segment_size=SEGMENT_SIZE):
+    """
+    Index a Stedsnavn GML file with several worker processes, that each parse and send their own segments of the file.
+    """
+
+    es = Elasticsearch(url)
     if not es.indices.exists(INDEX_NAME):
         es.indices.create(index=INDEX_NAME, body=INDEX_SETTINGS)
-    if len(sys.argv) != 2:
-        print(f"Invalid number of arguments. Script takes 1 argument but {len(sys.argv)-1} were provided.")
-        exit()
-    file = open(sys.argv[1], "rt", encoding="utf-8")
-
-    reader = iter(et.iterparse(file, events=("end",)))
-    actions = parse_stedsnavn_data(reader)
-    helpers.bulk(es, actions, chunk_size=500)
-    es.indices.refresh(index=INDEX_NAME)
\ No newline at end of file
+    check_schema(es)
+
+    segments = split_segments(file_path, segment_size)
+    with tqdm(total=sum(end - start for start, end in segments), unit="B", unit_scale=True) as progress:
+        with Pool(workers, initializer=__init_worker, initargs=(url,)) as pool:
+            for start, end in pool.imap_unordered(__index_segment, [(file_path, start, end, chunk_size) for start, end in segments]):
+                progress.update(end - start)
+
+    es.indices.refresh(index=INDEX_NAME)
+    # Store a new version on the index, so that the geoparser's gazetteer cache knows that the data has changed.
+    es.indices.put_mapping(index=INDEX_NAME, body={"_meta": {"schema_version": SCHEMA_VERSION, "version": datetime.now().isoformat()}})
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Index the Stedsnavn GML file in Elasticsearch.")
+    parser.add_argument("file_path", help="Path to the Stedsnavn GML file.")
+    parser.add_argument("--url", default="http://localhost:9200", help="Url of the Elasticsearch instance.")
+    parser.add_argument("--workers", type=int, default=4, help="Number of worker processes that parse and send documents.")
+    parser.add_argument("--chunk-size", type=int, default=500, help="Number of documents in each bulk request.")
+    parser.add_argument("--segment-size", type=int, default=SEGMENT_SIZE, help="Approximate size in bytes of the file segments handed to the workers.")
+    args = parser.parse_args()
+    index_stedsnavn(args.file_path, args.url, args.workers, args.chunk_size, args.segment_size)
@@ -0,0 +1,158 @@
+from typing import Any, Dict, Tuple
+from math import exp, log2
+from unidecode import unidecode
+from lists import ADMIN1_MAP, ADMIN2_MAP
+
+# Ranking features that only depend on a gazetteer entry itself. These are computed once by the indexers and stored on each entry,
+# so that the geoparser does not need to compute them for every candidate it retrieves.
+# Shared between the geoparser and the indexers, so it should not depend on anything but the standard library and unidecode.
+
+# Version of the index mappings and of the features stored on each entry. It is stored on the indexes when they are created, and indexes
+# with another version are missing fields that the geoparser relies on, so they have to be deleted and indexed again.
+SCHEMA_VERSION = 2
+
+def logistic_function(
+        x: float,
+        x0: float = 0,
+        l: float = 1,
+        k: float = 1
+) -> float:
+    """
+    Calculate the value of a logistic function with the given input parameters.
+
+    Parameters
+    ----------
+    x : float
+        The value to calculate for.
+    x0 : float
+        x0 is the x value of the function's midpoint.
+    l : float
+        The carrying capacity of the values of the function.
+    k : float
+        The growth rate of the function.
+
+    Returns
+    -------
+    float
+        The calculated value.
+    """
+
+    return l / (1 + exp(-k*(x-x0)))
+
+def pop_score(
+        population: int
+) -> float:
+    """
+    Calculate the population score for a candidate.
+    Uses a logistic function to produce an output.
+    The population size is scaled to better fit with the logistic function.
+
+    Parameters
+    ----------
+    population : int
+        The population size of a candidate.
+
+    Returns
+    -------
+    float
+        The score given a population size.
+    """
+
+    if population == 0: return 0
+    scaled_pop = population / 10000
+    return logistic_function(log2(scaled_pop), 3)
+
+def alt_names_score(
+        num_alt_names: int
+) -> float:
+    """
+    Calculate the alternate names score for a candidate.
+    Uses a logistic function to produce an output.
+
+    Parameters
+    ----------
+    num_alt_names : int
+        The number of alternate names for a candidate.
+
+    Returns
+    -------
+    float
+        The score given the number of alternate names.
+    """
+
+    if num_alt_names == 0: return 0
+    return logistic_function(log2(num_alt_names), 3)
+
+def geonames_features(
+        geonames_entry: Dict[str, Any]
+) -> Dict[str, Any]:
+    """
+    Compute the static ranking features of a GeoNames entry.
+
+    Parameters
+    ----------
+    geonames_entry : Dict[str, Any]
+        A GeoNames entry, as created by the GeoNames indexer.
+
+    Returns
+    -------
+    Dict[str, Any]
+        The fields to add to the entry.
+    """
+
+    return {"pop_score": pop_score(int(geonames_entry["population"])),
+            "alt_names_count": len(geonames_entry["alternatenames"]),
+            "alt_names_score": alt_names_score(len(geonames_entry["alternatenames"]))}
+
+# TODO: Stedsnavn entries can be part of multiple administrative divisions. Should augment the algorithm so that it can handle multiple entries.
+# For now we simply use the first entry administrative divisions.
+# TODO: We are currently using the ADMIN1_MAP and ADMIN2_MAP dictionaries to convert stedsnavn entry codes into geonames ones.
+# This is because the geonames index and accompanying admin code files still use outdated admin codes.
+# In the future, geonames will probably update its info, at which point these maps will be unnecessary.
+# https://www.kartverket.no/til-lands/fakta-om-norge/norske-fylke-og-kommunar
+def stedsnavn_features(
+        stedsnavn_entry: Dict[str, Any]
+) -> Dict[str, Any]:
+    """
+    Compute the static ranking features of a Stedsnavn entry, as well as the fields it needs to be used in the same way as a GeoNames entry.
+    The admin codes of the first administrative division are converted into the ones used by GeoNames.
+
+    Parameters
+    ----------
+    stedsnavn_entry : Dict[str, Any]
+        A Stedsnavn entry, as created by the Stedsnavn indexer.
+
+    Returns
+    -------
+    Dict[str, Any]
+        The fields to add to the entry.
+    """
+
+    return {"asciiname": unidecode(stedsnavn_entry["name"]),
+            "admin1_code": ADMIN1_MAP[stedsnavn_entry["admin_codes"][0][0]],
+            "admin2_code": ADMIN2_MAP[stedsnavn_entry["admin_codes"][0][1]],
+            "pop_score": 0, # Stedsnavn has no population data
+            "alt_names_count": len(stedsnavn_entry["alternatenames"]),
+            "alt_names_score": alt_names_score(len(stedsnavn_entry["alternatenames"]))}
+
+def hierarchy_key(
+        geonames_entry: Dict[str, Any]
+) -> Tuple[str, str, str]:
+    """
+    The key that identifies an administrative GeoNames entry (PCLI, ADM1 or ADM2) by its place in the administrative hierarchy.
+    Countries use empty admin1 and admin2 codes, and first order administrative divisions use an empty admin2 code.
+
+    Parameters
+    ----------
+    geonames_entry : Dict[str, Any]
+        A PCLI, ADM1 or ADM2 GeoNames entry.
+
+    Returns
+    -------
+    Tuple[str, str, str]
+        The (country_code, admin1_code, admin2_code) key.
+    """
+
+    if geonames_entry["feature_code"] == "PCLI": return (geonames_entry["country_code"], "", "")
+    if geonames_entry["feature_code"] == "ADM1": return (geonames_entry["country_code"], geonames_entry["admin1_code"], "")
+    return (geonames_entry["country_code"], geonames_entry["admin1_code"], geonames_entry["admin2_code"])
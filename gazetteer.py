@@ -0,0 +1,755 @@
+import csv
+import heapq
+import json
+import mmap
+import os
+import sys
+import time
+from abc import ABC, abstractmethod
+from array import array
+from hashlib import blake2b, sha1
+from typing import Any, Callable, Dict, Iterable, List, Tuple, Union
+import numpy as np
+from elasticsearch import Elasticsearch, helpers
+from elasticsearch.exceptions import TransportError
+from cache import DiskCache
+from utility import convert_geonames, convert_stedsnavn, GEONAMES_FIELDS, STEDSNAVN_FIELDS
+from lists import COUNTRY_NAMES
+from features import hierarchy_key, SCHEMA_VERSION
+
+# Feature codes of the GeoNames entries that make up the administrative hierarchy.
+ADMIN_FEATURE_CODES = ["PCLI", "ADM1", "ADM2"]
+
+# Whether names in each dataset have to match the place name exactly, or only up to capitalization.
+CASE_SENSITIVE = {"geonames": True, "stedsnavn": False}
+
+# Painless version of static_score(), used to rank candidates in Elasticsearch. Stedsnavn entries have no country code, and are all Norwegian.
+STATIC_SCORE_SCRIPT = "double country = doc.containsKey('country_code') ? params.countries.getOrDefault(doc['country_code'].value, 0.0) : params.countries.getOrDefault('NO', 0.0); " \
+                      "return params.pop_weight * doc['pop_score'].value + params.alt_names_weight * doc['alt_names_score'].value + params.country_weight * country;"
+
+class Gazetteer(ABC):
+    """
+    Interface for the gazetteers that the geoparser retrieves toponym candidates from.
+    A gazetteer holds the GeoNames and Stedsnavn datasets, and implementations define how each dataset is searched and how the administrative entries are retrieved.
+    GeoNames is always prioritized, and Stedsnavn is only used for names that have no GeoNames results.
+    """
+
+    def find_candidates(
+            self,
+            place_names: List[str],
+            mute_output: bool = False,
+            top_k: Union[int, None] = None,
+            score_params: Union[Dict[str, Any], None] = None
+    ) -> Dict[str, List[Dict[str, Any]]]:
+        """
+        Finds toponym candidates from either GeoNames or Stedsnavn for a list of location mentions.
+        Will prioritize GeoNames, and only uses Stedsnavn for names that got no results from the former.
+        Only toponyms where the name, ascii name, or one of the alternate names matches the place name are used.
+        Each unique name is only searched for once.
+
+        Parameters
+        ----------
+        place_names : List[str]
+            The place name strings that the datasets should be queried on. May contain duplicates.
+        mute_output : bool
+            Mute all text status output.
+        top_k : Union[int, None]
+            Only keep the top_k candidates of each name with the highest static_score(), ordered by that score. All candidates are kept if this is None.
+        score_params : Union[Dict[str, Any], None]
+            Keyword arguments for static_score(). The defaults of static_score() are used if this is None.
+
+        Returns
+        -------
+        Dict[str, List[Dict[str, Any]]]
+            Dictionary with every unique place name as key, and a list of its candidates as value.
+            The candidate lists are shared between mentions of the same name, and should be copied before they are modified.
+        """
+
+        unique_names = list(dict.fromkeys(place_names))
+        candidates = {}
+        if len(unique_names) == 0: return candidates
+
+        if score_params is None: score_params = {}
+        q_results = self._search_geonames(unique_names, top_k, score_params)
+        missing_names = []
+        for place_name in unique_names:
+            if place_name in COUNTRY_NAMES:
+                # TODO: Proper error handling
+                if len(q_results[place_name]) != 1:
+                    if not mute_output: print(f"Warning: Got an unexpected number of results from country query: {len(q_results[place_name])}.")
+                candidates[place_name] = [convert_geonames(q_results[place_name][0])] if len(q_results[place_name]) != 0 else []
+                continue
+
+            candidates[place_name] = [convert_geonames(result) for result in q_results[place_name]]
+            if len(candidates[place_name]) == 0: missing_names.append(place_name)
+
+        if len(missing_names) == 0: return self.__top_candidates(candidates, top_k, score_params)
+
+        q_results = self._search_stedsnavn(missing_names, top_k, score_params)
+        for place_name in missing_names:
+            candidates[place_name] = [convert_stedsnavn(result) for result in q_results[place_name]]
+        return self.__top_candidates(candidates, top_k, score_params)
+
+    def __top_candidates(
+            self,
+            candidates: Dict[str, List[Dict[str, Any]]],
+            top_k: Union[int, None],
+            score_params: Dict[str, Any]
+    ) -> Dict[str, List[Dict[str, Any]]]:
+        """
+        Keep the top_k candidates of each name with the highest static score.
+        Gazetteers that rank their results themselves already return at most top_k results, in which case this only puts them in a consistent order.
+
+        Parameters
+        ----------
+        candidates : Dict[str, List[Dict[str, Any]]]
+            The candidates of each place name.
+        top_k : Union[int, None]
+            The number of candidates to keep. All candidates are kept if this is None.
+        score_params : Dict[str, Any]
+            Keyword arguments for static_score().
+
+        Returns
+        -------
+        Dict[str, List[Dict[str, Any]]]
+            The kept candidates of each place name.
+        """
+
+        if top_k is None: return candidates
+        return {place_name: heapq.nlargest(top_k, place_candidates, key=lambda candidate: static_score(candidate, **score_params))
+                for place_name, place_candidates in candidates.items()}
+
+    @abstractmethod
+    def admin_entries(self) -> List[Dict[str, Any]]:
+        """
+        Retrieve every GeoNames entry that is part of the administrative hierarchy, i.e., every PCLI, ADM1 and ADM2 entry.
+
+        Returns
+        -------
+        List[Dict[str, Any]]
+            The GeoNames entries.
+        """
+
+    @abstractmethod
+    def hierarchy_entries(
+            self,
+            keys: List[Tuple[str, str, str]]
+    ) -> Dict[Tuple[str, str, str], List[Dict[str, Any]]]:
+        """
+        Retrieve the administrative GeoNames entries with the given places in the administrative hierarchy.
+        The keys are (country_code, admin1_code, admin2_code), as returned by hierarchy_key().
+
+        Parameters
+        ----------
+        keys : List[Tuple[str, str, str]]
+            The keys to look up.
+
+        Returns
+        -------
+        Dict[Tuple[str, str, str], List[Dict[str, Any]]]
+            The entries for every key. Keys without any entries point to an empty list.
+        """
+
+    @abstractmethod
+    def _search_geonames(
+            self,
+            place_names: List[str],
+            top_k: Union[int, None] = None,
+            score_params: Union[Dict[str, Any], None] = None
+    ) -> Dict[str, List[Dict[str, Any]]]:
+        """
+        Search GeoNames for a list of unique place names.
+        Names in COUNTRY_NAMES should only return PCLI entries. All other names should only return entries where
+        the name, ascii name, or one of the alternate names matches the place name.
+
+        Parameters
+        ----------
+        place_names : List[str]
+            The unique place names to search for.
+        top_k : Union[int, None]
+            If set, the search may be limited to the top_k entries with the highest static_score(). Returning more entries is allowed.
+        score_params : Union[Dict[str, Any], None]
+            Keyword arguments for static_score().
+
+        Returns
+        -------
+        Dict[str, List[Dict[str, Any]]]
+            The GeoNames entries found for each place name.
+        """
+
+    @abstractmethod
+    def _search_stedsnavn(
+            self,
+            place_names: List[str],
+            top_k: Union[int, None] = None,
+            score_params: Union[Dict[str, Any], None] = None
+    ) -> Dict[str, List[Dict[str, Any]]]:
+        """
+        Search Stedsnavn for a list of unique place names.
+        Should only return entries where the name or one of the alternate names matches the place name, ignoring capitalization.
+
+        Parameters
+        ----------
+        place_names : List[str]
+            The unique place names to search for.
+        top_k : Union[int, None]
+            If set, the search may be limited to the top_k entries with the highest static_score(). Returning more entries is allowed.
+        score_params : Union[Dict[str, Any], None]
+            Keyword arguments for static_score().
+
+        Returns
+        -------
+        Dict[str, List[Dict[str, Any]]]
+            The Stedsnavn entries found for each place name.
+        """
+
+class ElasticsearchGazetteer(Gazetteer):
+    """
+    Gazetteer backed by the "geonames_custom" and "stedsnavn" Elasticsearch indexes, as created by the scripts in es/.
+    Can optionally store its lookups in a persistent cache, which is used until the index a lookup came from is rebuilt.
+
+    Parameters
+    ----------
+    url : str
+        Url of the Elasticsearch instance.
+    cache : Union[DiskCache, None]
+        Persistent cache for lookups. No cache is used if this is None.
+    version_ttl : float
+        Number of seconds that the version of an index is reused before it is read again,
+        so a rebuilt index can take this long to be noticed by the cache.
+    """
+
+    def __init__(
+            self,
+            url: str = "http://localhost:9200",
+            cache: Union[DiskCache, None] = None,
+            version_ttl: float = 60
+    ) -> None:
+        self.es = Elasticsearch(url)
+        self.cache = cache
+        self.version_ttl = version_ttl
+        # The version of each index, with the time it was read.
+        self.index_versions = {}
+        self.__check_schema()
+
+    def admin_entries(self) -> List[Dict[str, Any]]:
+        query = {"query": {"bool": {"filter": [{"terms": {"feature_code": ADMIN_FEATURE_CODES}}]}}, "_source": GEONAMES_FIELDS}
+        if self.cache is not None:
+            cache_key = self.__cache_key("geonames_custom", self.__index_version("geonames_custom"), query)
+            entries = self.cache.get(cache_key)
+            if entries is not None: return entries
+        entries = [hit["_source"] for hit in helpers.scan(self.es, query=query, index="geonames_custom")]
+        if self.cache is not None: self.cache.set(cache_key, entries)
+        return entries
+
+    def hierarchy_entries(
+            self,
+            keys: List[Tuple[str, str, str]]
+    ) -> Dict[Tuple[str, str, str], List[Dict[str, Any]]]:
+        # The admin index stores the entries of each key under a deterministic id, so they can all be fetched with a single multi get.
+        ids = {key: ".".join(key) for key in keys}
+        results = {}
+        cache_keys = {}
+        if self.cache is not None:
+            index_version = self.__index_version("geonames_admin")
+            cache_keys = {key: self.__cache_key("geonames_admin", index_version, id) for key, id in ids.items()}
+            cached_results = self.cache.get_many(list(cache_keys.values()))
+            for key, cache_key in cache_keys.items():
+                if cache_key in cached_results: results[key] = cached_results[cache_key]
+
+        missing_keys = [key for key in keys if key not in results]
+        if len(missing_keys) == 0: return results
+
+        source_fields = [f"entries.{field}" for field in GEONAMES_FIELDS]
+        response = self.es.mget(body={"ids": [ids[key] for key in missing_keys]}, index="geonames_admin", _source_includes=source_fields)
+        for key, doc in zip(missing_keys, response["docs"]):
+            results[key] = doc["_source"]["entries"] if doc.get("found") else []
+
+        if self.cache is not None:
+            self.cache.set_many({cache_keys[key]: results[key] for key in missing_keys})
+        return results
+
+    def _search_geonames(
+            self,
+            place_names: List[str],
+            top_k: Union[int, None] = None,
+            score_params: Union[Dict[str, Any], None] = None
+    ) -> Dict[str, List[Dict[str, Any]]]:
+        searches = {}
+        for place_name in place_names:
+            if place_name in COUNTRY_NAMES:
+                # (type: phrase) ensures that the entire place name is present. Without it, a query for a place name like "Rio de Janeiro" would also return any place with "Rio" in it.
+                q = {
+                    "multi_match": {
+                        "query": place_name,
+                        "fields": ["name", "asciiname", "alternatenames"],
+                        "type": "phrase"
+                    }
+                }
+                # Should in theory only ever return one value anyways.
+                searches[place_name] = {"query": {"bool": {"filter": [{"term": {"feature_code": "PCLI"}}], "must": [q]}}, "_source": GEONAMES_FIELDS}
+            else:
+                # Exact lookups on the keyword subfields, so that only toponyms with a name equal to the place name are returned.
+                q = {"bool": {"should": [{"term": {f"{field}.keyword": place_name}} for field in ["name", "asciiname", "alternatenames"]]}}
+                searches[place_name] = self.__ranked_search({"bool": {"filter": [q]}}, GEONAMES_FIELDS, top_k, score_params)
+
+        # Country queries are already filtered on PCLI, and are not required to match the name exactly.
+        def result_filter(place_name, result):
+            return place_name in COUNTRY_NAMES or result["name"] == place_name or result["asciiname"] == place_name or place_name in result["alternatenames"]
+        return self.__multi_search("geonames_custom", searches, result_filter)
+
+    def _search_stedsnavn(
+            self,
+            place_names: List[str],
+            top_k: Union[int, None] = None,
+            score_params: Union[Dict[str, Any], None] = None
+    ) -> Dict[str, List[Dict[str, Any]]]:
+        searches = {}
+        for place_name in place_names:
+            # Lookups on the normalized subfields, so that e.g. a query for "Odda Kommune" also finds "Odda kommune".
+            q = {"bool": {"should": [{"term": {f"{field}.normalized": place_name}} for field in ["name", "alternatenames"]]}}
+            searches[place_name] = self.__ranked_search({"bool": {"filter": [q]}}, STEDSNAVN_FIELDS, top_k, score_params)
+
+        # The normalized subfields also ignore diacritics, which should still be respected, so only differences in capitalization are allowed.
+        def result_filter(place_name, result):
+            return _same_name(result["name"], place_name) or any(_same_name(name, place_name) for name in result["alternatenames"])
+        return self.__multi_search("stedsnavn", searches, result_filter)
+
+    def __ranked_search(
+            self,
+            query: Dict[str, Any],
+            source_fields: List[str],
+            top_k: Union[int, None],
+            score_params: Union[Dict[str, Any], None]
+    ) -> Dict[str, Any]:
+        """
+        Create the body of a candidate search. If top_k is set, the results are ranked by STATIC_SCORE_SCRIPT,
+        so that only the top_k results need to be returned.
+
+        Parameters
+        ----------
+        query : Dict[str, Any]
+            The query that finds the candidates.
+        source_fields : List[str]
+            The fields to return from each result.
+        top_k : Union[int, None]
+            The number of results to return. Up to 1000 unranked results are returned if this is None.
+        score_params : Union[Dict[str, Any], None]
+            Keyword arguments for static_score(), passed on to the script.
+
+        Returns
+        -------
+        Dict[str, Any]
+            The search body.
+        """
+
+        if top_k is None: return {"query": query, "size": 1000, "_source": source_fields}
+        params = {"pop_weight": 1, "alt_names_weight": 1, "country_weight": 1, "countries": {}}
+        params.update({key: value for key, value in (score_params or {}).items() if value is not None})
+        script = {"source": STATIC_SCORE_SCRIPT, "params": params}
+        return {"query": {"script_score": {"query": query, "script": script}}, "size": top_k, "_source": source_fields}
+
+    def __multi_search(
+            self,
+            index: str,
+            searches: Dict[str, Dict[str, Any]],
+            result_filter: Callable[[str, Dict[str, Any]], bool]
+    ) -> Dict[str, List[Dict[str, Any]]]:
+        """
+        Run several searches against an index in a single multi search request.
+        The results are read directly from the raw response, and the searches should use source filtering to only return the fields that are needed.
+        If the cache is enabled, searches that have already been run against the current version of the index are read from the cache instead.
+
+        Parameters
+        ----------
+        index : str
+            The index to search.
+        searches : Dict[str, Dict[str, Any]]
+            The search bodies, keyed by the place name they search for.
+        result_filter : Callable[[str, Dict[str, Any]], bool]
+            Takes a place name and the source of one of its search results, and returns whether the result should be kept.
+            Only the kept results are stored in the cache.
+
+        Returns
+        -------
+        Dict[str, List[Dict[str, Any]]]
+            The sources of the kept results of each search, keyed by place name.
+        """
+
+        results = {}
+        cache_keys = {}
+        if self.cache is not None:
+            index_version = self.__index_version(index)
+            cache_keys = {place_name: self.__cache_key(index, index_version, search) for place_name, search in searches.items()}
+            cached_results = self.cache.get_many(list(cache_keys.values()))
+            for place_name, cache_key in cache_keys.items():
+                if cache_key in cached_results: results[place_name] = cached_results[cache_key]
+
+        missing_names = [place_name for place_name in searches if place_name not in results]
+        if len(missing_names) == 0: return results
+
+        body = []
+        for place_name in missing_names:
+            body.append({})
+            body.append(searches[place_name])
+        response = self.es.msearch(body=body, index=index)
+        for place_name, q_results in zip(missing_names, response["responses"]):
+            if "error" in q_results:
+                raise TransportError("N/A", q_results["error"]["type"], q_results["error"])
+            results[place_name] = [hit["_source"] for hit in q_results["hits"]["hits"] if result_filter(place_name, hit["_source"])]
+
+        if self.cache is not None:
+            self.cache.set_many({cache_keys[place_name]: results[place_name] for place_name in missing_names})
+        return results
+
+    def __check_schema(self) -> None:
+        """
+        Make sure that the indexes were created with the current mapping and features, as indexes created with an older version of
+        the indexers are missing fields that are searched and ranked by, and would silently return no candidates.
+        """
+
+        for index in ["geonames_custom", "stedsnavn"]:
+            meta = next(iter(self.es.indices.get_mapping(index=index).values()))["mappings"].get("_meta", {})
+            if meta.get("schema_version") != SCHEMA_VERSION:
+                raise RuntimeError(f"The \"{index}\" index has schema version {meta.get('schema_version')} instead of {SCHEMA_VERSION}, reindex required: delete it and index it again with the scripts in es/")
+
+    def __index_version(
+            self,
+            index: str
+    ) -> str:
+        """
+        Get a string that identifies the current version of an Elasticsearch index.
+        It combines the index's uuid, which changes when the index is recreated, with the version stored in its mapping metadata by the indexers.
+        It is only read from Elasticsearch once every version_ttl seconds.
+
+        Parameters
+        ----------
+        index : str
+            Name of the index.
+
+        Returns
+        -------
+        str
+            The index version.
+        """
+
+        now = time.monotonic()
+        if index in self.index_versions:
+            read_time, index_version = self.index_versions[index]
+            if now - read_time < self.version_ttl: return index_version
+        index_info = next(iter(self.es.indices.get(index=index).values()))
+        uuid = index_info["settings"]["index"]["uuid"]
+        version = index_info["mappings"].get("_meta", {}).get("version", "")
+        index_version = f"{uuid}:{version}"
+        self.index_versions[index] = (now, index_version)
+        return index_version
+
+    def __cache_key(
+            self,
+            index: str,
+            index_version: str,
+            query: Dict[str, Any]
+    ) -> str:
+        """
+        Create the cache key for a query against a given version of an index.
+
+        Parameters
+        ----------
+        index : str
+            Name of the index.
+        index_version : str
+            Version of the index, as returned by __index_version().
+        query : Dict[str, Any]
+            The query body.
+
+        Returns
+        -------
+        str
+            The cache key.
+        """
+
+        return sha1(json.dumps([index, index_version, query], sort_keys=True).encode("utf-8")).hexdigest()
+
+class MemoryGazetteer(Gazetteer):
+    """
+    Gazetteer that runs entirely in-process, without Elasticsearch. It finds the same exact name matches as ElasticsearchGazetteer.
+    Reads the files created by build_memory_gazetteer(), which are memory mapped instead of being read into memory.
+    For each dataset there is a file with all entries as JSON lines, and a name index.
+    The name index is a sorted array of 64-bit hashes of every name, ascii name and alternate name, with a matching array of entry offsets.
+    Stedsnavn names are lowercased before they are hashed, as they are matched regardless of capitalization.
+
+    Parameters
+    ----------
+    directory : str
+        Folder with the files created by build_memory_gazetteer().
+    """
+
+    def __init__(
+            self,
+            directory: str
+    ) -> None:
+        self.directory = directory
+        self.docs = {}
+        self.name_hashes = {}
+        self.name_offsets = {}
+        for dataset in ["geonames", "stedsnavn"]:
+            with open(os.path.join(directory, f"{dataset}.docs"), "rb") as file:
+                # Empty files can not be memory mapped.
+                self.docs[dataset] = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(file.fileno()).st_size != 0 else b""
+            self.name_hashes[dataset] = np.load(os.path.join(directory, f"{dataset}.hashes.npy"), mmap_mode="r")
+            self.name_offsets[dataset] = np.load(os.path.join(directory, f"{dataset}.offsets.npy"), mmap_mode="r")
+        self.admin_offsets = np.load(os.path.join(directory, "geonames.admin.npy"), mmap_mode="r")
+        self.hierarchy = None
+
+    def admin_entries(self) -> List[Dict[str, Any]]:
+        return [self.__read_doc("geonames", int(offset)) for offset in self.admin_offsets]
+
+    def hierarchy_entries(
+            self,
+            keys: List[Tuple[str, str, str]]
+    ) -> Dict[Tuple[str, str, str], List[Dict[str, Any]]]:
+        # The administrative entries are few enough that they are simply grouped in memory the first time they are needed.
+        if self.hierarchy is None:
+            self.hierarchy = {}
+            for entry in self.admin_entries():
+                self.hierarchy.setdefault(hierarchy_key(entry), []).append(entry)
+        return {key: self.hierarchy.get(key, []) for key in keys}
+
+    def _search_geonames(
+            self,
+            place_names: List[str],
+            top_k: Union[int, None] = None,
+            score_params: Union[Dict[str, Any], None] = None
+    ) -> Dict[str, List[Dict[str, Any]]]:
+        # Entries are read straight from memory, so find_candidates() ranks and truncates them afterwards.
+        results = {}
+        for place_name in place_names:
+            entries = [entry for entry in self.__lookup("geonames", place_name) \
+                       if entry["name"] == place_name or entry["asciiname"] == place_name or place_name in entry["alternatenames"]]
+            if place_name in COUNTRY_NAMES:
+                entries = [entry for entry in entries if entry["feature_code"] == "PCLI"]
+            results[place_name] = entries
+        return results
+
+    def _search_stedsnavn(
+            self,
+            place_names: List[str],
+            top_k: Union[int, None] = None,
+            score_params: Union[Dict[str, Any], None] = None
+    ) -> Dict[str, List[Dict[str, Any]]]:
+        results = {}
+        for place_name in place_names:
+            results[place_name] = [entry for entry in self.__lookup("stedsnavn", place_name) \
+                                   if _same_name(entry["name"], place_name) or any(_same_name(name, place_name) for name in entry["alternatenames"])]
+        return results
+
+    def __lookup(
+            self,
+            dataset: str,
+            name: str
+    ) -> List[Dict[str, Any]]:
+        """
+        Find the entries in a dataset with a name that has the same hash as the given name.
+        Hash collisions are possible, so the caller still needs to compare the names.
+
+        Parameters
+        ----------
+        dataset : str
+            Either "geonames" or "stedsnavn".
+        name : str
+            The name to look up.
+
+        Returns
+        -------
+        List[Dict[str, Any]]
+            The matching entries.
+        """
+
+        name_hash = np.uint64(_name_hash(name if CASE_SENSITIVE[dataset] else name.lower()))
+        start = np.searchsorted(self.name_hashes[dataset], name_hash, side="left")
+        end = np.searchsorted(self.name_hashes[dataset], name_hash, side="right")
+        offsets = dict.fromkeys(int(offset) for offset in self.name_offsets[dataset][start:end])
+        return [self.__read_doc(dataset, offset) for offset in offsets]
+
+    def __read_doc(
+            self,
+            dataset: str,
+            offset: int
+    ) -> Dict[str, Any]:
+        """
+        Read a single entry from a dataset's JSON lines file.
+
+        Parameters
+        ----------
+        dataset : str
+            Either "geonames" or "stedsnavn".
+        offset : int
+            Byte offset of the entry in the file.
+
+        Returns
+        -------
+        Dict[str, Any]
+            The entry.
+        """
+
+        docs = self.docs[dataset]
+        return json.loads(docs[offset:docs.find(b"\n", offset)])
+
+def static_score(
+        candidate: Dict[str, Any],
+        pop_weight: float = 1,
+        alt_names_weight: float = 1,
+        country_weight: float = 1,
+        countries: Union[Dict[str, float], None] = None
+) -> float:
+    """
+    The part of a candidate's score that does not depend on the rest of the text, apart from the inferred countries.
+    Used to pick the candidates that are worth ranking when only the top candidates are retrieved.
+
+    Parameters
+    ----------
+    candidate : Dict[str, Any]
+        A candidate, as created by convert_geonames() or convert_stedsnavn().
+    pop_weight : float
+        How much the candidate's population score counts.
+    alt_names_weight : float
+        How much the candidate's alternate names score counts.
+    country_weight : float
+        How much the relevance of the candidate's country counts.
+    countries : Union[Dict[str, float], None]
+        Relevance of each inferred country, see infer_countries().
+
+    Returns
+    -------
+    float
+        The static score.
+    """
+
+    country_score = countries.get(candidate["country_code"], 0) if countries is not None else 0
+    return pop_weight * candidate["pop_score"] + alt_names_weight * candidate["alt_names_score"] + country_weight * country_score
+
+def _same_name(
+        name: str,
+        place_name: str
+) -> bool:
+    """
+    Check if a Stedsnavn name matches a place name, ignoring capitalization.
+
+    Parameters
+    ----------
+    name : str
+        Name of a Stedsnavn entry.
+    place_name : str
+        The place name that was searched for.
+
+    Returns
+    -------
+    bool
+        Whether the names match.
+    """
+
+    return name.lower() == place_name.lower()
+
+def _name_hash(
+        name: str
+) -> int:
+    """
+    64-bit hash of a name, used in the name index of the memory gazetteer.
+    Python's built-in hash() can not be used, as it is different for every process.
+
+    Parameters
+    ----------
+    name : str
+        The name to hash.
+
+    Returns
+    -------
+    int
+        The hash as an unsigned integer.
+    """
+
+    return int.from_bytes(blake2b(name.encode("utf-8"), digest_size=8).digest(), "little")
+
+def build_memory_gazetteer(
+        geonames_path: str,
+        stedsnavn_path: str,
+        directory: str
+) -> None:
+    """
+    Create the files used by MemoryGazetteer from the GeoNames and Stedsnavn dataset files.
+    The entries are parsed the same way as when they are indexed in Elasticsearch.
+
+    Parameters
+    ----------
+    geonames_path : str
+        Path to the GeoNames "allCountries.txt" file.
+    stedsnavn_path : str
+        Path to the Stedsnavn GML file.
+    directory : str
+        Folder to write the files to. It is created if it does not exist.
+    """
+
+    # The indexers are imported here, as they are only needed when building.
+    from es.geonames_indexer import parse_geonames_data
+    from es.stedsnavn_indexer import parse_stedsnavn_data, read_segment
+
+    os.makedirs(directory, exist_ok=True)
+    with open(geonames_path, "rt", encoding="utf-8") as file:
+        reader = csv.reader(file, delimiter="\t")
+        admin_offsets = __build_dataset(directory, "geonames", (action["_source"] for action in parse_geonames_data(reader)), ["name", "asciiname"])
+    np.save(os.path.join(directory, "geonames.admin.npy"), np.frombuffer(admin_offsets, dtype=np.int64))
+
+    __build_dataset(directory, "stedsnavn", (action["_source"] for action in parse_stedsnavn_data(read_segment(stedsnavn_path))), ["name"])
+
+def __build_dataset(
+        directory: str,
+        dataset: str,
+        entries: Iterable[Dict[str, Any]],
+        name_fields: List[str]
+) -> array:
+    """
+    Write the JSON lines file and name index for one dataset.
+
+    Parameters
+    ----------
+    directory : str
+        Folder to write the files to.
+    dataset : str
+        Either "geonames" or "stedsnavn".
+    entries : Iterable[Dict[str, Any]]
+        The dataset entries.
+    name_fields : List[str]
+        The fields that, together with the alternate names, should be added to the name index.
+
+    Returns
+    -------
+    array
+        Byte offsets of every administrative entry (PCLI, ADM1 and ADM2) in the JSON lines file.
+    """
+
+    name_hashes = array("Q")
+    name_offsets = array("q")
+    admin_offsets = array("q")
+    with open(os.path.join(directory, f"{dataset}.docs"), "wb") as docs_file:
+        for entry in entries:
+            offset = docs_file.tell()
+            docs_file.write(json.dumps(entry, ensure_ascii=False).encode("utf-8") + b"\n")
+            names = {entry[field] for field in name_fields} | set(entry["alternatenames"])
+            for name in names:
+                if not name: continue
+                name_hashes.append(_name_hash(name if CASE_SENSITIVE[dataset] else name.lower()))
+                name_offsets.append(offset)
+            if entry.get("feature_code") in ADMIN_FEATURE_CODES: admin_offsets.append(offset)
+
+    # Stable sort keeps entries with the same name in file order.
+    name_hashes = np.frombuffer(name_hashes, dtype=np.uint64)
+    order = np.argsort(name_hashes, kind="stable")
+    np.save(os.path.join(directory, f"{dataset}.hashes.npy"), name_hashes[order])
+    np.save(os.path.join(directory, f"{dataset}.offsets.npy"), np.frombuffer(name_offsets, dtype=np.int64)[order])
+    return admin_offsets
+
+if __name__ == "__main__":
+    if len(sys.argv) != 4:
+        print(f"Invalid number of arguments. Script takes 3 arguments but {len(sys.argv)-1} were provided.")
+        exit()
+    build_memory_gazetteer(sys.argv[1], sys.argv[2], sys.argv[3])
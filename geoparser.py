@@ -1,16 +1,278 @@
 import spacy
-from typing import Callable, Any, List, Dict, Tuple
-from elasticsearch import Elasticsearch
-from elasticsearch_dsl import Search
+from spacy.language import Language
+from spacy.tokens import Doc
+from typing import Callable, Any, List, Dict, Tuple, Union, Iterable
 from utility import *
 from lists import *
 from math import isclose, log2
 from copy import deepcopy
 from typing import Counter
+from cache import DiskCache
+from gazetteer import Gazetteer, ElasticsearchGazetteer, CASE_SENSITIVE, _same_name
+from features import hierarchy_key
+import os
+import pickle
+from bisect import bisect_left
+import numpy as np
+import re
+
+# Folder with the GeoNames admin code files. Defaults to the data/ folder next to this file, and can be changed with the GEOPARSER_DATA_DIR environment variable.
+DATA_DIR = os.environ.get("GEOPARSER_DATA_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data"))
+
+# All official GeoNames admin codes, mapping codes such as "NO.12" and "NO.12.0301" to the name of the administrative division.
+# These are filled by load_admin_codes() the first time the geoparser runs.
+ADMIN1_CODES: Dict[str, str] = {}
+ADMIN2_CODES: Dict[str, str] = {}
+
+def load_admin_codes(
+        data_dir: Union[str, None] = None,
+        reload: bool = False
+) -> Tuple[Dict[str, str], Dict[str, str]]:
+    """
+    Load the GeoNames admin1 and admin2 codes into ADMIN1_CODES and ADMIN2_CODES.
+    The codes are only loaded once per process, unless reload is set.
+    The parsed codes are cached in "admin_codes.pickle" in the data folder, which is used instead of the text files as long as they have not changed.
+
+    Parameters
+    ----------
+    data_dir : Union[str, None]
+        Folder with the files "admin1CodesASCII.txt" and "admin2Codes.txt". Uses DATA_DIR if not set.
+    reload : bool
+        Load the codes again even if they have already been loaded.
+    
+    Returns
+    -------
+    Tuple[Dict[str, str], Dict[str, str]]
+        The admin1 and admin2 codes, with their names as values.
+    """
+
+    if len(ADMIN1_CODES) != 0 and not reload: return ADMIN1_CODES, ADMIN2_CODES
+    if data_dir is None: data_dir = DATA_DIR
+
+    admin1_path = os.path.join(data_dir, "admin1CodesASCII.txt")
+    admin2_path = os.path.join(data_dir, "admin2Codes.txt")
+    cache_path = os.path.join(data_dir, "admin_codes.pickle")
+    # Used to tell if the cache was made from the current version of the text files.
+    source_stamp = [(os.path.getmtime(path), os.path.getsize(path)) for path in (admin1_path, admin2_path)]
+
+    admin_codes = None
+    if os.path.exists(cache_path):
+        try:
+            with open(cache_path, "rb") as file:
+                admin_codes = pickle.load(file)
+        except Exception:
+            pass # A cache that can not be read is rebuilt from the text files.
+        if not isinstance(admin_codes, dict) or admin_codes.get("source_stamp") != source_stamp: admin_codes = None
+    if admin_codes is None:
+        admin1 = read_admin1(admin1_path)
+        admin2 = read_admin2(admin2_path)
+        admin_codes = {
+            "source_stamp": source_stamp,
+            "admin1": {code: str(name) for code, name in zip(admin1[0], admin1[1])},
+            "admin2": {code: str(name) for code, name in zip(admin2[0], admin2[1])}
+        }
+        # The cache is written to a file of its own and then moved into place, so that other processes never read a partly written cache.
+        temp_path = f"{cache_path}.{os.getpid()}.tmp"
+        try:
+            with open(temp_path, "wb") as file:
+                pickle.dump(admin_codes, file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, cache_path)
+        except OSError:
+            # The data folder might be read only, in which case the text files are simply read every time.
+            if os.path.exists(temp_path): os.remove(temp_path)
+
+    ADMIN1_CODES.clear()
+    ADMIN1_CODES.update(admin_codes["admin1"])
+    ADMIN2_CODES.clear()
+    ADMIN2_CODES.update(admin_codes["admin2"])
+    return ADMIN1_CODES, ADMIN2_CODES
+
+# Process-wide registry of loaded spaCy pipelines, keyed by model name and enabled components.
+# Loading a pipeline takes several seconds, so it should only ever happen once per process.
+NLP_MODELS: Dict[Tuple[str, Union[Tuple[str, ...], None]], Language] = {}
+
+def load_nlp(
+        model_name: str = "nb_core_news_lg",
+        components: Union[Iterable[str], None] = ("ner",)
+) -> Language:
+    """
+    Load a spaCy pipeline, or return it from the registry if it has already been loaded in this process.
+    Can be called ahead of geoparsing to warm up the model.
+
+    Parameters
+    ----------
+    model_name : str
+        Name of the spaCy model to load.
+    components : Union[Iterable[str], None]
+        The pipeline components that should stay enabled, in any order. All other components are disabled.
+        The geoparser only depends on "ner". Setting this to None keeps every component enabled.
+    
+    Returns
+    -------
+    Language
+        The loaded spaCy pipeline.
+    """
+
+    # The same components given in another order, or as another type of iterable, should use the same pipeline.
+    if components is not None: components = tuple(sorted(components))
+    key = (model_name, components)
+    if key not in NLP_MODELS:
+        if components is None:
+            NLP_MODELS[key] = spacy.load(model_name)
+        else:
+            NLP_MODELS[key] = spacy.load(model_name, enable=list(components))
+    return NLP_MODELS[key]
+
+# The gazetteer that candidates are retrieved from. Defaults to an ElasticsearchGazetteer, which is created the first time it is needed.
+GAZETTEER: Union[Gazetteer, None] = None
+
+def set_gazetteer(
+        gazetteer: Gazetteer
+) -> None:
+    """
+    Set the gazetteer that the geoparser retrieves candidates from, e.g., a MemoryGazetteer to run without Elasticsearch.
+    The hierarchy index is rebuilt from the new gazetteer the next time the geoparser runs.
+
+    Parameters
+    ----------
+    gazetteer : Gazetteer
+        The gazetteer to use.
+    """
+
+    global GAZETTEER
+    GAZETTEER = gazetteer
+    HIERARCHY_INDEX.clear()
+
+def get_gazetteer() -> Gazetteer:
+    """
+    Get the gazetteer that the geoparser retrieves candidates from.
+    If none has been set, an ElasticsearchGazetteer connected to "http://localhost:9200" is created.
+
+    Returns
+    -------
+    Gazetteer
+        The gazetteer in use.
+    """
+
+    global GAZETTEER
+    if GAZETTEER is None: GAZETTEER = ElasticsearchGazetteer("http://localhost:9200")
+    return GAZETTEER
 
-# These are read here to increase performance.
-ADMIN1_LIST = read_admin1("data/admin1CodesASCII.txt")[0].to_list()
-ADMIN2_LIST = read_admin2("data/admin2Codes.txt")[0].to_list()
+def enable_gazetteer_cache(
+        path: Union[str, None] = None,
+        max_size: int = 1024**3
+) -> DiskCache:
+    """
+    Enable the persistent gazetteer cache. Once enabled, candidate lookups and the hierarchy index are stored on disk,
+    and reused by later runs until the Elasticsearch index they came from is rebuilt.
+    Only available when candidates are retrieved from Elasticsearch.
+
+    Parameters
+    ----------
+    path : Union[str, None]
+        Path to the cache file. Defaults to "gazetteer_cache.sqlite" in DATA_DIR.
+    max_size : int
+        The maximum size of the cache in bytes. The least recently used entries are removed when it is full.
+    
+    Returns
+    -------
+    DiskCache
+        The gazetteer cache.
+    """
+
+    gazetteer = get_gazetteer()
+    if not isinstance(gazetteer, ElasticsearchGazetteer):
+        raise ValueError("The gazetteer cache can only be used with an ElasticsearchGazetteer.")
+    if path is None: path = os.path.join(DATA_DIR, "gazetteer_cache.sqlite")
+    if gazetteer.cache is not None: gazetteer.cache.close()
+    gazetteer.cache = DiskCache(path, max_size)
+    return gazetteer.cache
+
+def disable_gazetteer_cache() -> None:
+    """
+    Disable the persistent gazetteer cache. The cache file is kept on disk.
+    """
+
+    gazetteer = get_gazetteer()
+    if not isinstance(gazetteer, ElasticsearchGazetteer): return
+    if gazetteer.cache is not None: gazetteer.cache.close()
+    gazetteer.cache = None
+
+def enable_pdf_cache(
+        path: Union[str, None] = None,
+        max_size: int = 1024**3
+) -> DiskCache:
+    """
+    Enable the persistent pdf cache. Once enabled, the text the pdf parsers in pdf_parsing read from each page is stored on disk,
+    so that geoparse_pdf() only has to parse a file again if it has changed, or is parsed with different settings.
+
+    Parameters
+    ----------
+    path : Union[str, None]
+        Path to the cache file. Defaults to "pdf_cache.sqlite" in DATA_DIR.
+    max_size : int
+        The maximum size of the cache in bytes. The least recently used entries are removed when it is full.
+    
+    Returns
+    -------
+    DiskCache
+        The pdf cache.
+    """
+
+    # Imported here, so that the pdf parsing dependencies are only needed when parsing pdf files.
+    import pdf_parsing
+    if path is None: path = os.path.join(DATA_DIR, "pdf_cache.sqlite")
+    if pdf_parsing.PAGE_CACHE is not None: pdf_parsing.PAGE_CACHE.close()
+    pdf_parsing.PAGE_CACHE = DiskCache(path, max_size)
+    return pdf_parsing.PAGE_CACHE
+
+def disable_pdf_cache() -> None:
+    """
+    Disable the persistent pdf cache. The cache file is kept on disk.
+    """
+
+    import pdf_parsing
+    if pdf_parsing.PAGE_CACHE is not None: pdf_parsing.PAGE_CACHE.close()
+    pdf_parsing.PAGE_CACHE = None
+
+# In-memory index of the administrative GeoNames entries (PCLI, ADM1 and ADM2), keyed by (country_code, admin1_code, admin2_code).
+# Countries use empty admin1 and admin2 codes, and first order administrative divisions use an empty admin2 code.
+# Each key points to a list, as GeoNames can have more than one entry for the same administrative division.
+# Entries are fetched from the gazetteer as they are needed by __load_ancestors(), and are kept for the rest of the process.
+HIERARCHY_INDEX: Dict[Tuple[str, str, str], List[Dict[str, Any]]] = {}
+
+def load_hierarchy_index(
+        gazetteer: Union[Gazetteer, None] = None,
+        reload: bool = False
+) -> Dict[Tuple[str, str, str], List[Dict[str, Any]]]:
+    """
+    Read every administrative GeoNames entry into the hierarchy index at once.
+    This is not needed, as the entries are otherwise fetched as the geoparser needs them, but avoids any lookups when geoparsing a large number of texts.
+
+    Parameters
+    ----------
+    gazetteer : Union[Gazetteer, None]
+        The gazetteer to read the entries from. Uses get_gazetteer() if not set.
+    reload : bool
+        Clear the index before reading the entries, e.g., after GeoNames has been reindexed.
+    
+    Returns
+    -------
+    Dict[Tuple[str, str, str], List[Dict[str, Any]]]
+        The hierarchy index.
+    """
+
+    if gazetteer is None: gazetteer = get_gazetteer()
+
+    hierarchy_index = {}
+    for entry in gazetteer.admin_entries():
+        key = hierarchy_key(entry)
+        if key not in hierarchy_index: hierarchy_index[key] = []
+        hierarchy_index[key].append(entry)
+
+    if reload: HIERARCHY_INDEX.clear()
+    HIERARCHY_INDEX.update(hierarchy_index)
+    return HIERARCHY_INDEX
 
 def geoparse_pdf(
         file_path: str,
@@ -29,7 +291,12 @@ def geoparse_pdf(
         adm1_candidates_weight: float = 1,
         adm1_text_weight: float = 1,
         country_cutoff: int = 3,
-        adm1_cutoff: int = 3
+        adm1_cutoff: int = 3,
+        model_name: str = "nb_core_news_lg",
+        nlp_components: Union[Iterable[str], None] = ("ner",),
+        top_k: Union[int, None] = None,
+        rank_top_n: Union[int, None] = None,
+        rank_lossless: bool = False
 ) -> Dict[str, Any]:
     """
     Geoparse a pdf file. This function is essentially a wrapper for geoparse(), but takes a pdf parser as input.
@@ -40,7 +307,7 @@ def geoparse_pdf(
         File path to pdf file.
     pdf_parser : Callable[[str, bool], str]
         A pdf parser, that takes a file path as input, and outputs a raw string of text.
-        There are two available pdf parsers implemented in this solution: ocr_parse() and pypdf2_parse().
+        There are three available pdf parsers implemented in this solution: ocr_parse(), pypdf2_parse() and hybrid_parse().
     is_wikipedia : bool
         If the pdf file is from a wikipedia article.
         Makes the pdf parsers perform extra actions to remove clutter from the articles that might otherwise reduce geoparsing performance.
@@ -72,6 +339,19 @@ def geoparse_pdf(
         The number of countries inferred.
     adm1_cutoff : int
         The number of first order administrative divisions inferred.
+    model_name : str
+        Name of the spaCy model used for NER. The model is only loaded once per process, see load_nlp().
+    nlp_components : Union[Iterable[str], None]
+        The spaCy pipeline components that should stay enabled. Set to None to keep all components enabled.
+    top_k : Union[int, None]
+        Only rank the top_k candidates of each location entity, picked by the gazetteer from their population and alternate names scores and the inferred countries.
+        Speeds up geoparsing of very ambiguous names. All candidates are ranked if this is None.
+    rank_top_n : Union[int, None]
+        Only rank the rank_top_n candidates of each location entity with the highest population, alternate names, country and admin1 scores.
+        The remaining candidates are left out of the results. All candidates are ranked if this is None.
+    rank_lossless : bool
+        Also rank the candidates after the first rank_top_n that could still be ranked first, so that the top candidate is always the same as without rank_top_n.
+        Only the candidates that can not be ranked first are left out, which is not a limit on how many candidates are ranked.
     
     Returns
     -------
@@ -83,7 +363,7 @@ def geoparse_pdf(
     text = pdf_parser(file_path, is_wikipedia)
     if not mute_output: print(f"Finished parsing PDF")
     return geoparse(text, mute_output, pop_weight, alt_names_weight, country_weight, admin1_weight, ancestor_weight, descendant_weight, common_hierarchies_weight,
-                     co_candidates_weight, co_text_weight, adm1_candidates_weight, adm1_text_weight, country_cutoff, adm1_cutoff)
+                     co_candidates_weight, co_text_weight, adm1_candidates_weight, adm1_text_weight, country_cutoff, adm1_cutoff, model_name, nlp_components, top_k, rank_top_n, rank_lossless)
 
 def geoparse(
         text: str,
@@ -100,7 +380,12 @@ def geoparse(
         adm1_candidates_weight: float = 1,
         adm1_text_weight: float = 1,
         country_cutoff: int = 3,
-        adm1_cutoff: int = 3
+        adm1_cutoff: int = 3,
+        model_name: str = "nb_core_news_lg",
+        nlp_components: Union[Iterable[str], None] = ("ner",),
+        top_k: Union[int, None] = None,
+        rank_top_n: Union[int, None] = None,
+        rank_lossless: bool = False
 ) -> List[Dict[str, Any]]:
     """
     The main geoparsing function. It will go through the provided text, and return all toponyms it identifies in the text.
@@ -137,6 +422,19 @@ def geoparse(
         The number of countries inferred.
     adm1_cutoff : int
         The number of first order administrative divisions inferred.
+    model_name : str
+        Name of the spaCy model used for NER. The model is only loaded once per process, see load_nlp().
+    nlp_components : Union[Iterable[str], None]
+        The spaCy pipeline components that should stay enabled. Set to None to keep all components enabled.
+    top_k : Union[int, None]
+        Only rank the top_k candidates of each location entity, picked by the gazetteer from their population and alternate names scores and the inferred countries.
+        Speeds up geoparsing of very ambiguous names. All candidates are ranked if this is None.
+    rank_top_n : Union[int, None]
+        Only rank the rank_top_n candidates of each location entity with the highest population, alternate names, country and admin1 scores.
+        The remaining candidates are left out of the results. All candidates are ranked if this is None.
+    rank_lossless : bool
+        Also rank the candidates after the first rank_top_n that could still be ranked first, so that the top candidate is always the same as without rank_top_n.
+        Only the candidates that can not be ranked first are left out, which is not a limit on how many candidates are ranked.
     
     Returns
     -------
@@ -145,9 +443,154 @@ def geoparse(
     """
     
     if not mute_output: print("Started geoparsing")
-    locations_data = []
-    nlp = spacy.load("nb_core_news_lg")
+    nlp = load_nlp(model_name, nlp_components)
     doc = nlp(text)
+    gazetteer = get_gazetteer()
+    load_admin_codes()
+    results = __geoparse_doc(doc, gazetteer, mute_output, pop_weight, alt_names_weight, country_weight, admin1_weight, ancestor_weight, descendant_weight, common_hierarchies_weight,
+                             co_candidates_weight, co_text_weight, adm1_candidates_weight, adm1_text_weight, country_cutoff, adm1_cutoff, top_k, rank_top_n, rank_lossless)
+    if not mute_output: print("Finished geoparsing")
+    return results
+
+def geoparse_many(
+        texts: Iterable[str],
+        batch_size: int = 64,
+        n_process: int = 1,
+        mute_output: bool = False,
+        pop_weight: float = 1,
+        alt_names_weight: float = 1,
+        country_weight: float = 1,
+        admin1_weight: float = 1,
+        ancestor_weight: float = 1,
+        descendant_weight: float = 1,
+        common_hierarchies_weight: float = 1,
+        co_candidates_weight: float = 1,
+        co_text_weight: float = 1,
+        adm1_candidates_weight: float = 1,
+        adm1_text_weight: float = 1,
+        country_cutoff: int = 3,
+        adm1_cutoff: int = 3,
+        model_name: str = "nb_core_news_lg",
+        nlp_components: Union[Iterable[str], None] = ("ner",),
+        top_k: Union[int, None] = None,
+        rank_top_n: Union[int, None] = None,
+        rank_lossless: bool = False
+) -> List[Dict[str, Any]]:
+    """
+    Geoparse a collection of texts. NER is run over all texts in batches with spaCy's nlp.pipe(),
+    after which candidate retrieval and ranking is done for each text separately, using the same gazetteer.
+    Every text is geoparsed independently, so the results are the same as calling geoparse() on each text.
+
+    Parameters
+    ----------
+    texts : Iterable[str]
+        The texts that should be geoparsed.
+    batch_size : int
+        The number of texts spaCy should process in each batch.
+    n_process : int
+        The number of processes spaCy should use for NER. Set to -1 to use all available CPUs.
+    mute_output : bool
+        Mute all text status output of the geoparser.
+    pop_weight : float
+        How much a candidate's population size should contribute to the overall score.
+    alt_names_weight : float
+        How much a candidate's number of alternate names should contribute to the overall score.
+    country_weight : float
+        How much the inferred countries should affect the overall score.
+    admin1_weight : float
+        How much the inferred first order administrative divisions should affect the overall score.
+    ancestor_weight : float
+        How much the text mentions of a candidate's geographical ancestors should contribute to the overall score.
+    descendant_weight : float
+        How much the text mentions of a candidate's geographical descendants should contribute to the overall score.
+    common_hierarchies_weight : float
+        How much common a candidate's common hierarchies should contribute to the overall score.
+    co_candidates_weight : float
+        How much candidate mentions should contribute when inferring countries.
+    co_text_weight : float
+        How much text mentions should contribute when inferring countries.
+    adm1_candidates_weight : float
+        How much candidate mentions should contribute when inferring first order administrative divisions.
+    adm1_text_weight : float
+        How much text mentions should contribute when inferring first order administrative divisions.
+    country_cutoff : int
+        The number of countries inferred.
+    adm1_cutoff : int
+        The number of first order administrative divisions inferred.
+    model_name : str
+        Name of the spaCy model used for NER. The model is only loaded once per process, see load_nlp().
+    nlp_components : Union[Iterable[str], None]
+        The spaCy pipeline components that should stay enabled. Set to None to keep all components enabled.
+    top_k : Union[int, None]
+        Only rank the top_k candidates of each location entity, picked by the gazetteer from their population and alternate names scores and the inferred countries.
+        Speeds up geoparsing of very ambiguous names. All candidates are ranked if this is None.
+    rank_top_n : Union[int, None]
+        Only rank the rank_top_n candidates of each location entity with the highest population, alternate names, country and admin1 scores.
+        The remaining candidates are left out of the results. All candidates are ranked if this is None.
+    rank_lossless : bool
+        Also rank the candidates after the first rank_top_n that could still be ranked first, so that the top candidate is always the same as without rank_top_n.
+        Only the candidates that can not be ranked first are left out, which is not a limit on how many candidates are ranked.
+    
+    Returns
+    -------
+    List[Dict[str, Any]]
+        One result per text, in the same order as the input. Each result has the same format as the output of geoparse().
+    """
+
+    if not mute_output: print("Started geoparsing")
+    nlp = load_nlp(model_name, nlp_components)
+    gazetteer = get_gazetteer()
+    load_admin_codes()
+    results = []
+    for i, doc in enumerate(nlp.pipe(texts, batch_size=batch_size, n_process=n_process)):
+        if not mute_output: print(f"Geoparsing text {i + 1}")
+        results.append(__geoparse_doc(doc, gazetteer, mute_output, pop_weight, alt_names_weight, country_weight, admin1_weight, ancestor_weight, descendant_weight, common_hierarchies_weight,
+                                      co_candidates_weight, co_text_weight, adm1_candidates_weight, adm1_text_weight, country_cutoff, adm1_cutoff, top_k, rank_top_n, rank_lossless))
+    if not mute_output: print("Finished geoparsing")
+    return results
+
+def __geoparse_doc(
+        doc: Doc,
+        gazetteer: Gazetteer,
+        mute_output: bool = False,
+        pop_weight: float = 1,
+        alt_names_weight: float = 1,
+        country_weight: float = 1,
+        admin1_weight: float = 1,
+        ancestor_weight: float = 1,
+        descendant_weight: float = 1,
+        common_hierarchies_weight: float = 1,
+        co_candidates_weight: float = 1,
+        co_text_weight: float = 1,
+        adm1_candidates_weight: float = 1,
+        adm1_text_weight: float = 1,
+        country_cutoff: int = 3,
+        adm1_cutoff: int = 3,
+        top_k: Union[int, None] = None,
+        rank_top_n: Union[int, None] = None,
+        rank_lossless: bool = False
+) -> Dict[str, Any]:
+    """
+    Geoparse a single document that has already been processed by spaCy.
+    Retrieves candidates for every location entity in the document, and ranks them.
+
+    Parameters
+    ----------
+    doc : Doc
+        spaCy document with named entities.
+    gazetteer : Gazetteer
+        The gazetteer to retrieve candidates from.
+    
+    See geoparse() for the remaining parameters.
+
+    Returns
+    -------
+    Dict[str, Any]
+        A dictionary containing the inferred countries and first order administrative divisions, as well as the actual geoparsing results.
+    """
+
+    text = doc.text
+    locations_data = []
     entities = [ent for ent in doc.ents if ent.label_ in ["GPE", "LOC", "GPE_LOC", "GPE_ORG"]]
     for entity in entities:
         entity_name = entity.text.strip()
@@ -164,21 +607,37 @@ def geoparse(
             "candidates": []
             })
 
-    es = Elasticsearch("http://localhost:9200")
     entity_names = [location["entity_name"] for location in locations_data]
 
     if not mute_output: print("Finding candidates")
+    score_params = {"pop_weight": pop_weight, "alt_names_weight": alt_names_weight}
+    candidates = gazetteer.find_candidates(entity_names, mute_output, top_k, score_params)
     for location in locations_data:
-        location["candidates"] = __find_candidates(es, location["entity_name"], mute_output)
+        # Mentions of the same name are ranked separately, so each one needs its own copy of the candidates.
+        location["candidates"] = [candidate.copy() for candidate in candidates[location["entity_name"]]]
     
     inferred_countries = __infer_countries(locations_data, mute_output, co_candidates_weight, co_text_weight, country_cutoff)
-    inferred_adm1 = __infer_adm1(locations_data, es, mute_output, adm1_candidates_weight, adm1_text_weight, adm1_cutoff)
+    if top_k is not None:
+        # The countries are inferred from candidates that were picked without them. Names that may have more candidates
+        # than were retrieved are searched again, so that candidates in the inferred countries are preferred.
+        truncated_names = [place_name for place_name, place_candidates in candidates.items() if len(place_candidates) >= top_k]
+        if len(truncated_names) != 0 and len(inferred_countries) != 0:
+            score_params.update({"country_weight": country_weight, "countries": inferred_countries})
+            candidates.update(gazetteer.find_candidates(truncated_names, mute_output, top_k, score_params))
+            for location in locations_data:
+                if location["entity_name"] not in truncated_names: continue
+                location["candidates"] = [candidate.copy() for candidate in candidates[location["entity_name"]]]
+    __load_ancestors(gazetteer, locations_data)
+    inferred_adm1 = __infer_adm1(locations_data, mute_output, adm1_candidates_weight, adm1_text_weight, adm1_cutoff)
     
     if not mute_output: print("Ranking candidates")
+    mention_index = __build_mention_index(locations_data)
+    candidate_index = __build_candidate_index(locations_data)
+    context_features = {}
+    word_offsets = __build_word_offsets(text)
     for location in locations_data:
-        __rank(location, locations_data, es, text, inferred_countries, inferred_adm1, mute_output,
-             pop_weight, alt_names_weight, country_weight, admin1_weight, ancestor_weight, descendant_weight, common_hierarchies_weight)
-    if not mute_output: print("Finished geoparsing")
+        __rank(location, mention_index, candidate_index, context_features, text, word_offsets, inferred_countries, inferred_adm1, mute_output,
+             pop_weight, alt_names_weight, country_weight, admin1_weight, ancestor_weight, descendant_weight, common_hierarchies_weight, rank_top_n, rank_lossless)
     return {
         "inferred_countries": inferred_countries, 
         "inferred_admin1": inferred_adm1, 
@@ -229,72 +688,31 @@ def __handle_duplicates(
         results.append(locations_data_copy[best_index])
     return results
 
-def __find_candidates(
-        es: Elasticsearch,
-        place_name: str,
-        mute_output: bool = False
-) -> List[Dict[str, Any]]:
+def __build_word_offsets(
+        text: str
+) -> np.ndarray:
     """
-    Finds toponym candidates from either GeoNames or Stedsnavn for a given location mention.
-    Will prioritize GeoNames, and only uses Stedsnavn if no results are returned from the former.
-    Discards any results where the query string does not match a toponym's name, ascii name, or one of its alternate names.
+    Build a cumulative word count table for a text, so that the number of words between two character positions can be found without slicing the text.
+    A word is any run of non-whitespace characters, the same as with str.split().
 
     Parameters
     ----------
-    es : Elasticsearch
-        Elasticsearch instance. Must have the indexes "geonames_custom" and "stedsnavn" to retrieve candidates from the respective datasets.
-    place_name : str
-        The place name string that the datasets should be queried on.
-    mute_output : bool
-        Mute all text status output.
+    text : str
+        The text that is being geoparsed.
     
     Returns
     -------
-    List[Dict[str, Any]]
-        A list of candidates for the given place name.
+    np.ndarray
+        Array of length len(text) + 1, where index i holds the number of words that start before character position i.
     """
 
-    s = Search(using=es, index="geonames_custom")
-
-    # (type: phrase) ensures that the entire place name is present. Without it, a query for a place name like "Rio de Janeiro" would also return any place with "Rio" in it.
-    q = {
-        "multi_match": {
-            "query": place_name,
-            "fields": ["name", "asciiname", "alternatenames"],
-            "type": "phrase"
-        }
-    }
-
-    if place_name in COUNTRY_NAMES:
-        q_results = s.filter("term", feature_code="PCLI").query(q).execute() # Should in theory only ever return one value anyways.
-        # TODO: Proper error handling
-        if len(q_results) != 1:
-            if not mute_output: print(f"Warning: Got an unexpected number of results from country query: {len(q_results)}.")
-        return [convert_geonames(q_results[0].to_dict())]
-
-    q_results = s.query(q)[0:1000].execute()
-
-    # Only use results that match the entity name perfectly.
-    results = [convert_geonames(result.to_dict()) for result in q_results if result["name"] == place_name or result["asciiname"] == place_name or place_name in result["alternatenames"]]
-    if len(results) != 0:
-        return results
-    
-    s = Search(using=es, index="stedsnavn")
-    q = {
-        "multi_match": {
-            "query": place_name,
-            "fields": ["name", "alternatenames"],
-            "type": "phrase"
-        }
-    }
-    q_results = s.query(q)[0:1000].execute()
-    # TODO: This currently omits results based on capitalization, e.g., query for "Odda Kommune" will result in "Odda kommune",
-    # which therefore gets omitted in the below check.
-    results = [convert_stedsnavn(result.to_dict()) for result in q_results if result["name"] == place_name or place_name in result["alternatenames"]]
-    return results
+    word_offsets = np.zeros(len(text) + 1, dtype=np.int32)
+    word_offsets[[match.start() + 1 for match in re.finditer(r"\S+", text)]] = 1
+    return np.cumsum(word_offsets, dtype=np.int32)
 
 def __calculate_entity_distance(
         text: str,
+        word_offsets: np.ndarray,
         location_entity1: Dict[str, Any],
         location_entity2: Dict[str, Any]
 ) -> int:
@@ -305,6 +723,8 @@ def __calculate_entity_distance(
     ----------
     text : str
         The text where the entities are located.
+    word_offsets : np.ndarray
+        Cumulative word count table for the text, built with __build_word_offsets().
     location_entity1 : Dict[str, Any]
         The first entity.
     location_entity2 : Dict[str, Any]
@@ -316,11 +736,74 @@ def __calculate_entity_distance(
         The distance between the two entities.
     """
 
-    distance = 0
     if location_entity1["start_char"] < location_entity2["end_char"]:
-        distance = len(text[location_entity1["end_char"]:location_entity2["start_char"]].split()) + 1
+        start, end = location_entity1["end_char"], location_entity2["start_char"]
     else:
-        distance = len(text[location_entity2["end_char"]:location_entity1["start_char"]].split()) + 1
+        start, end = location_entity2["end_char"], location_entity1["start_char"]
+    if end <= start: return 1
+
+    # Words that start between the entities, plus the remainder of a word that the span starts in the middle of, e.g. a trailing comma.
+    distance = int(word_offsets[end] - word_offsets[start])
+    if start > 0 and not text[start].isspace() and not text[start - 1].isspace(): distance += 1
+    return distance + 1
+
+def __build_mention_index(
+        locations_data: List[Dict[str, Any]]
+) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Group all location entities by their name, sorted by where they are in the text.
+
+    Parameters
+    ----------
+    locations_data : List[Dict[str, Any]]
+        All location entities in the geoparsing process.
+    
+    Returns
+    -------
+    Dict[str, List[Dict[str, Any]]]
+        Dictionary with entity names as keys, that point to every mention of the name sorted by start character index.
+    """
+
+    mention_index = {}
+    for location in locations_data:
+        if location["entity_name"] not in mention_index: mention_index[location["entity_name"]] = []
+        mention_index[location["entity_name"]].append(location)
+    for mentions in mention_index.values():
+        mentions.sort(key=lambda mention: mention["start_char"])
+    return mention_index
+
+def __find_nearest_mention_distance(
+        text: str,
+        word_offsets: np.ndarray,
+        location: Dict[str, Any],
+        mentions: List[Dict[str, Any]]
+) -> Union[int, None]:
+    """
+    Find the shortest distance in text between a location entity and any of the given mentions.
+    Since the mentions are sorted, the closest one is always either the last mention before the location entity, or the first one after it.
+
+    Parameters
+    ----------
+    text : str
+        The text where the entities are located.
+    word_offsets : np.ndarray
+        Cumulative word count table for the text, built with __build_word_offsets().
+    location : Dict[str, Any]
+        The location entity that a distance should be calculated for.
+    mentions : List[Dict[str, Any]]
+        Mentions of a single name, sorted by start character index, as returned by __build_mention_index().
+    
+    Returns
+    -------
+    Union[int, None]
+        The shortest distance, or None if there are no mentions.
+    """
+
+    i = bisect_left(mentions, location["start_char"], key=lambda mention: mention["start_char"])
+    distance = None
+    for mention in mentions[max(i - 1, 0):i + 1]:
+        mention_distance = __calculate_entity_distance(text, word_offsets, location, mention)
+        if distance is None or mention_distance < distance: distance = mention_distance
     return distance
 
 def __infer_countries(
@@ -375,6 +858,9 @@ def __infer_countries(
                 candidates_mentions[candidate["country_code"]] = 1
             else: candidates_mentions[candidate["country_code"]] += 1
     
+    # No candidates were found for any location entity, so there is nothing to infer.
+    if len(candidates_mentions) == 0: return {}
+
     # Calculate a combined weighted sum between country mentions in text and country mentions in candidates.
     weighted_mentions = {}
     total_mentions_candidates = sum(candidates_mentions.values())
@@ -405,7 +891,6 @@ def __infer_countries(
 
 def __infer_adm1(
         locations_data: List[Dict[str, Any]],
-        es: Elasticsearch,
         mute_output: bool = False,
         candidates_weight: float = 1,
         text_weight: float = 1,
@@ -419,8 +904,6 @@ def __infer_adm1(
     ----------
     locations_data : List[Dict[str, Any]]
         Data on every location entity, including its name, as well as the candidates that have been found for it.
-    es : Elasticsearch
-        Elasticsearch instance that must have the "geonames_custom" index.
     mute_output : bool
         Mute all text status output.
     candidates_weight : float
@@ -447,7 +930,7 @@ def __infer_adm1(
             country_admin1 = candidate["country_code"] + "." + candidate["admin1_code"]
 
             # This will ignore any admin code not in the official geonames list. Admin codes such as historical ones.
-            if country_admin1 not in ADMIN1_LIST: continue
+            if country_admin1 not in ADMIN1_CODES: continue
 
             # Do not count if the admin1 has already been counted for this location entity.
             if country_admin1 in candidates_adm1: continue
@@ -459,22 +942,14 @@ def __infer_adm1(
                 candidate_mentions[candidate["country_code"]][candidate["admin1_code"]] = 1
             else: candidate_mentions[candidate["country_code"]][candidate["admin1_code"]] += 1
     
-    # For all adm1 mentions retrieved in the previous process, find their entry in Elasticsearch.
+    # No candidates belong to a known admin1, so there is nothing to infer.
+    if len(candidate_mentions) == 0: return {}
+
+    # For all adm1 mentions retrieved in the previous process, find their entry in the hierarchy index.
     adm1_mentions = []
     for country_code, value in candidate_mentions.items():
         for adm1_code, _ in value.items():
-            s = Search(using=es, index="geonames_custom")
-            q = {
-                "bool": {
-                    "must": [
-                        {"match": {"country_code": {"query": country_code}}},
-                        {"match": {"admin1_code": {"query": adm1_code}}},
-                        {"match": {"feature_code": {"query": "ADM1"}}},
-                        # {"query_string": {"query": "(ADM1) OR (ADM1H)", "fields": ["feature_code"]}}
-                    ]
-                }
-            }
-            q_results = s.query(q).execute()
+            q_results = HIERARCHY_INDEX.get((country_code, adm1_code, ""), [])
 
             if len(q_results) > 1:
                 if not mute_output: print(f"Info: Found more than one result for adm1 query. adm1: {adm1_code}, country: {country_code}")
@@ -483,7 +958,7 @@ def __infer_adm1(
                 if not mute_output: print(f"Info: Found no results for adm1 query. adm1: {adm1_code}, country: {country_code}")
                 continue
             # Should only ever be one result in q_results here anyways, so it is fine to use indexing.
-            adm1_mentions.append(q_results[0].to_dict())
+            adm1_mentions.append(q_results[0])
     
     # Make a new dictionary containing all the entries in candidate mentions, but set each count to 0.
     text_mentions = deepcopy(candidate_mentions)
@@ -495,7 +970,7 @@ def __infer_adm1(
     # Count the number of times an admin1 is mentioned in the text.
     for location in locations_data:
         for adm1_mention in adm1_mentions:
-            if location["entity_name"] == adm1_mention["name"] or location["entity_name"] == adm1_mention["asciiname"] or location["entity_name"] in adm1_mention["alternatenames"]:
+            if __has_name(location["entity_name"], adm1_mention):
                 text_mentions[adm1_mention["country_code"]][adm1_mention["admin1_code"]] += 1
     
     # Calculate total number of mentions.
@@ -559,21 +1034,49 @@ def __infer_adm1(
     
     return top_n_refactored
 
+def __load_ancestors(
+        gazetteer: Gazetteer,
+        locations_data: List[Dict[str, Any]]
+) -> None:
+    """
+    Make sure the hierarchy index contains the possible ancestors of every candidate in a document.
+    Every administrative entry that is not already in the index is fetched from the gazetteer in one request.
+
+    Parameters
+    ----------
+    gazetteer : Gazetteer
+        The gazetteer to retrieve the administrative entries from.
+    locations_data : List[Dict[str, Any]]
+        List of all location entities with their candidates.
+    """
+
+    keys = set()
+    for location in locations_data:
+        for candidate in location["candidates"]:
+            country_code = candidate["country_code"]
+            admin1_code = candidate["admin1_code"]
+            admin2_code = candidate["admin2_code"]
+            keys.add((country_code, "", ""))
+            if f"{country_code}.{admin1_code}" in ADMIN1_CODES: keys.add((country_code, admin1_code, ""))
+            if f"{country_code}.{admin1_code}.{admin2_code}" in ADMIN2_CODES: keys.add((country_code, admin1_code, admin2_code))
+
+    missing_keys = [key for key in keys if key not in HIERARCHY_INDEX]
+    if len(missing_keys) == 0: return
+    HIERARCHY_INDEX.update(gazetteer.hierarchy_entries(missing_keys))
+
 def __get_ancestors(
         candidate: Dict[str, Any],
-        es: Elasticsearch,
         mute_output: bool = False
 ) -> Dict[str, Dict[str, Any]]:
     """
     Retrieve the ancestors for a candidate. Ancestors in this context, refer to the administrative divisions a toponym belongs to.
     I.e., A first order administrative division belongs to a country, etc. 
+    The ancestors are looked up in the hierarchy index, which must have been filled with __load_ancestors().
 
     Parameters
     ----------
     candidate : Dict[str, Any]
         Candidate to find ancestors for.
-    es : Elasticsearch
-        Elasticsearch instance to search for ancestors. Must have the "geonames_custom" index.
     mute_output : bool
         Mute all text status output.
 
@@ -590,74 +1093,108 @@ def __get_ancestors(
     admin1_code = candidate['admin1_code']
     admin2_code = candidate['admin2_code']
 
-    s = Search(using=es, index="geonames_custom")
-
-    # Search for country geonames entry.
+    # Find country geonames entry.
     if not (feature_code == "PCLI" or feature_code == "nasjon"):
-        q = {
-            "bool": {
-                "must": [
-                    {"match": {"country_code": {"query": country_code}}},
-                    {"match": {"feature_code": {"query": "PCLI"}}}
-                ]
-            }
-        }
-        q_results = s.query(q).execute()
+        q_results = HIERARCHY_INDEX.get((country_code, "", ""), [])
 
         if len(q_results) > 1:
             if not mute_output: print(f"Warning: Found more than one result for country query. country: {country_code}")
         elif len(q_results) == 0:
             if not mute_output: print(f"Info: Found no results for country query. country: {country_code}")
         else:
-            ancestors["country"] = q_results[0].to_dict()
-
-    # Search for admin1 geonames entry.
-    if f"{country_code}.{admin1_code}" in ADMIN1_LIST and not (feature_code == "ADM1" or feature_code == "fylke"):
-        q = {
-            "bool": {
-                "must": [
-                    {"match": {"country_code": {"query": country_code}}},
-                    {"match": {"admin1_code": {"query": admin1_code}}},
-                    {"match": {"feature_code": {"query": "ADM1"}}}
-                ]
-            }
-        }
-        q_results = s.query(q).execute()
+            ancestors["country"] = q_results[0]
+
+    # Find admin1 geonames entry.
+    if f"{country_code}.{admin1_code}" in ADMIN1_CODES and not (feature_code == "ADM1" or feature_code == "fylke"):
+        q_results = HIERARCHY_INDEX.get((country_code, admin1_code, ""), [])
 
         if len(q_results) > 1:
             if not mute_output: print(f"Warning: Found more than one result for adm1 query. adm1: {admin1_code}, country: {country_code}")
         elif len(q_results) == 0:
             if not mute_output: print(f"Info: Found no results for adm1 query. adm1: {admin1_code}, country: {country_code}")
         else:
-            ancestors["admin1"] = q_results[0].to_dict()
-
-    # Search for admin2 geonames entry.
-    if f"{country_code}.{admin1_code}.{admin2_code}" in ADMIN2_LIST and not (feature_code == "ADM2" or feature_code == "kommune"):
-        q = {
-            "bool": {
-                "must": [
-                    {"match": {"country_code": {"query": country_code}}},
-                    {"match": {"admin1_code": {"query": admin1_code}}},
-                    {"match": {"admin2_code": {"query": admin2_code}}},
-                    {"match": {"feature_code": {"query": "ADM2"}}}
-                ]
-            }
-        }
-        q_results = s.query(q).execute()
+            ancestors["admin1"] = q_results[0]
+
+    # Find admin2 geonames entry.
+    if f"{country_code}.{admin1_code}.{admin2_code}" in ADMIN2_CODES and not (feature_code == "ADM2" or feature_code == "kommune"):
+        q_results = HIERARCHY_INDEX.get((country_code, admin1_code, admin2_code), [])
 
         if len(q_results) > 1:
             if not mute_output: print(f"Warning: Found more than one result for adm2 query. adm2: {admin2_code}, adm1: {admin1_code}, country: {country_code}")
         elif len(q_results) == 0:
             if not mute_output: print(f"Info: Found no results for adm2 query. adm2: {admin2_code}, adm1: {admin1_code}, country: {country_code}")
         else:
-            ancestors["admin2"] = q_results[0].to_dict()
+            ancestors["admin2"] = q_results[0]
 
     return ancestors
 
+def __build_candidate_index(
+        locations_data: List[Dict[str, Any]]
+) -> Dict[str, Dict[Tuple[str, ...], List[Tuple[Dict[str, Any], Dict[str, Any]]]]]:
+    """
+    Group the candidates of all location entities by their administrative divisions.
+    The index is built once per document before ranking, so that hierarchical relationships can be found without going through every candidate.
+
+    Parameters
+    ----------
+    locations_data : List[Dict[str, Any]]
+        All location entities in the geoparsing process.
+    
+    Returns
+    -------
+    Dict[str, Dict[Tuple[str, ...], List[Tuple[Dict[str, Any], Dict[str, Any]]]]]
+        A dictionary with "admin1" and "admin2" as keys. "admin1" groups candidates by (country_code, admin1_code),
+        and "admin2" groups candidates by (country_code, admin1_code, admin2_code). Each entry is a (location, candidate) pair,
+        where location is the first mention of a name.
+    """
+
+    candidate_index = {"admin1": {}, "admin2": {}}
+    indexed_names = set()
+    for location in locations_data:
+        # All mentions of a name have the same candidates, so only the first one needs to be indexed.
+        # The distance to the closest mention is found with __find_nearest_mention_distance() when scoring.
+        if location["entity_name"] in indexed_names: continue
+        indexed_names.add(location["entity_name"])
+        for candidate in location["candidates"]:
+            admin1_key = (candidate["country_code"], candidate["admin1_code"])
+            admin2_key = (candidate["country_code"], candidate["admin1_code"], candidate["admin2_code"])
+            if admin1_key not in candidate_index["admin1"]: candidate_index["admin1"][admin1_key] = []
+            if admin2_key not in candidate_index["admin2"]: candidate_index["admin2"][admin2_key] = []
+            candidate_index["admin1"][admin1_key].append((location, candidate))
+            candidate_index["admin2"][admin2_key].append((location, candidate))
+    return candidate_index
+
+def __has_name(
+        entity_name: str,
+        entry: Dict[str, Any],
+        dataset: str = "geonames"
+) -> bool:
+    """
+    Check if the name of a location entity is one of the names of a gazetteer entry, compared in the same way as when candidates are looked up.
+
+    Parameters
+    ----------
+    entity_name : str
+        Name of the location entity.
+    entry : Dict[str, Any]
+        The gazetteer entry.
+    dataset : str
+        The dataset the entry is from, which decides whether capitalization is ignored.
+
+    Returns
+    -------
+    bool
+        Whether the entry has the name.
+    """
+
+    names = [entry["name"], entry["asciiname"], *entry["alternatenames"]]
+    if CASE_SENSITIVE[dataset]: return entity_name in names
+    return any(_same_name(name, entity_name) for name in names)
+
 def __find_common_hierarchies(
         candidate: Dict[str, Any],
         candidate_location: Dict[str, Any],
-        locations_data: List[Dict[str, Any]],  
+        candidate_index: Dict[str, Dict[Tuple[str, ...], List[Tuple[Dict[str, Any], Dict[str, Any]]]]],
 ) -> Dict[str, Dict[str, Any]]:
     """
     Find candidates that share a common hierarchy with the given candidate.
@@ -669,13 +1206,14 @@ def __find_common_hierarchies(
         Candidate to find common hierarchies for.
     candidate_location : Dict[str, Any]
         The location entity that the candidate belongs to.
-    locations_data : List[Dict[str, Any]]
-        All location entities in the geoparsing process.
+    candidate_index : Dict[str, Dict[Tuple[str, ...], List[Tuple[Dict[str, Any], Dict[str, Any]]]]]
+        The candidates of all location entities, grouped by __build_candidate_index().
     
     Returns
     -------
     Dict[str, Dict[str, Any]]
-        A dictionary with "admin1" and "admin2" as keys, that each point to lists of candidates for the given hierarchical relationships.
+        A dictionary with "admin1" and "admin2" as keys, that each point to lists of candidates for the given hierarchical relationships,
+        as well as the name of the location entity they belong to.
     """
 
     common_hierarchies = {"admin1": [], "admin2": []}
@@ -683,32 +1221,30 @@ def __find_common_hierarchies(
     if candidate["feature_code"] in admin_feature_codes: return common_hierarchies
     if candidate["admin1_code"] == "" or candidate["admin2_code"] == "": return common_hierarchies
 
-    for location in locations_data:
-        for location_candidate in location["candidates"]:
+    # Only candidates in the same country and admin1 can share a common hierarchy.
+    for location, location_candidate in candidate_index["admin1"].get((candidate["country_code"], candidate["admin1_code"]), []):
 
-            # Candidate should not be checked against itself.
-            if candidate_location["entity_name"] == location_candidate["name"] or candidate_location["entity_name"] == location_candidate["asciiname"] \
-                or candidate_location["entity_name"] in location_candidate["alternatenames"]: continue
-            
-            if location_candidate["feature_code"] in admin_feature_codes: continue
-            if location_candidate["admin1_code"] == "" or location_candidate["admin2_code"] == "": continue
-            if candidate["admin1_code"] == location_candidate["admin1_code"] and candidate["country_code"] == location_candidate["country_code"]:
-                # The candidates match admin1 codes.
-                if candidate["admin2_code"] == location_candidate["admin2_code"]:
-                    # The candidates also match admin2 codes.
-                    common_hierarchies["admin2"].append({"candidate": location_candidate, "start_char": location["start_char"], "end_char": location["end_char"]})
-                else: common_hierarchies["admin1"].append({"candidate": location_candidate, "start_char": location["start_char"], "end_char": location["end_char"]})
+        # Candidate should not be checked against itself, or against other candidates for the same name.
+        if location["entity_name"] == candidate_location["entity_name"]: continue
+        if __has_name(candidate_location["entity_name"], location_candidate, location_candidate["dataset"]): continue
+        
+        if location_candidate["feature_code"] in admin_feature_codes: continue
+        if location_candidate["admin2_code"] == "": continue
+        if candidate["admin2_code"] == location_candidate["admin2_code"]:
+            # The candidates also match admin2 codes.
+            common_hierarchies["admin2"].append({"candidate": location_candidate, "entity_name": location["entity_name"]})
+        else: common_hierarchies["admin1"].append({"candidate": location_candidate, "entity_name": location["entity_name"]})
     
     return common_hierarchies
 
 def __find_hierarchical_descendants(
         candidate: Dict[str, Any],
         candidate_location: Dict[str, Any],
-        locations_data: List[Dict[str, Any]],
+        candidate_index: Dict[str, Dict[Tuple[str, ...], List[Tuple[Dict[str, Any], Dict[str, Any]]]]],
 ) -> List[Dict[str, Any]]:
     """
     Find hierarchical descendants for a candidate.
-    The function will search through all candidates for all location entities, and see if any of them are its potential hierarchical descendants.
+    The function will search through the candidates in the same administrative division as the candidate, and see if any of them are its potential hierarchical descendants.
 
     Parameters
     ----------
@@ -716,13 +1252,13 @@ def __find_hierarchical_descendants(
         Candidate to find descendants for.
     candidate_location : Dict[str, Any]
         The location entity that the candidate belongs to.
-    locations_data : List[Dict[str, Any]]
-        All location entities in the geoparsing process.
+    candidate_index : Dict[str, Dict[Tuple[str, ...], List[Tuple[Dict[str, Any], Dict[str, Any]]]]]
+        The candidates of all location entities, grouped by __build_candidate_index().
     
     Returns
     -------
-    Dict[str, int]
-        A list of all descendants, as well as their start and end character indexes in the text.
+    List[Dict[str, Any]]
+        A list of all descendants, as well as the name of the location entity they belong to.
     """
     
     admin_feature_codes = ["ADM1", "ADM2"]
@@ -731,80 +1267,91 @@ def __find_hierarchical_descendants(
     # TODO: The way of handling the appended values here is not great.
     # For candidate: find children amongst the other location entities candidates.
     hierarchical_descendants = []
-    for location in locations_data:
-        for location_candidate in location["candidates"]:
+    if candidate["feature_code"] == "ADM1":
+        bucket = candidate_index["admin1"].get((candidate["country_code"], candidate["admin1_code"]), [])
+    else:
+        bucket = candidate_index["admin2"].get((candidate["country_code"], candidate["admin1_code"], candidate["admin2_code"]), [])
+    for location, location_candidate in bucket:
 
-            # Candidate should not be checked against itself.
-            if candidate_location["entity_name"] == location_candidate["name"] or candidate_location["entity_name"] == location_candidate["asciiname"] \
-                or candidate_location["entity_name"] in location_candidate["alternatenames"]: continue
-            
-            if candidate["feature_code"] == "ADM1":
-                if location_candidate["feature_code"] == "ADM1": continue
-                if location_candidate["admin1_code"] == candidate["admin1_code"]:
-                    # Found an admin1 descendant
-                    hierarchical_descendants.append({"candidate": location_candidate, "start_char": location["start_char"], "end_char": location["end_char"]})
-            if candidate["feature_code"] == "ADM2":
-                if location_candidate["feature_code"] == "ADM2": continue
-                if location_candidate["admin1_code"] == candidate["admin1_code"] and location_candidate["admin2_code"] == candidate["admin2_code"]:
-                    # Found an admin2 descendant
-                    hierarchical_descendants.append({"candidate": location_candidate, "start_char": location["start_char"], "end_char": location["end_char"]})
+        # Candidate should not be checked against itself, or against other candidates for the same name.
+        if location["entity_name"] == candidate_location["entity_name"]: continue
+        if __has_name(candidate_location["entity_name"], location_candidate, location_candidate["dataset"]): continue
+        
+        # Found a descendant, as long as it is not on the same administrative level.
+        if location_candidate["feature_code"] == candidate["feature_code"]: continue
+        hierarchical_descendants.append({"candidate": location_candidate, "entity_name": location["entity_name"]})
     return hierarchical_descendants
 
-def __find_ancestor_distances(
-        ancestors: Dict[str, Dict[str, Any]],
+def __get_context_features(
+        candidate: Dict[str, Any],
         location: Dict[str, Any],
-        locations_data: List[Dict[str, Any]],
-        text: str
-) -> Dict[str, int]:
+        mention_index: Dict[str, List[Dict[str, Any]]],
+        candidate_index: Dict[str, Dict[Tuple[str, ...], List[Tuple[Dict[str, Any], Dict[str, Any]]]]],
+        context_features: Dict[Tuple[str, str, Any], Dict[str, Dict[str, Any]]],
+        mute_output: bool = False
+) -> Dict[str, Dict[str, Any]]:
     """
-    Find the distance in text between a location entity and one of its candidate's ancestors.
-    A candidate's ancestors, are toponyms that are higher in its hierarchical tree.
-    Will only calculate these distances if they actually exist in the text.
+    Get the location entities in the text that a candidate is hierarchically related to, i.e., that mention its ancestors, descendants or common hierarchies.
+    These only depend on the candidate and the name of the location entity it belongs to, so they are found once per document and stored in context_features,
+    where they are shared by every mention of the name. Only the distances to the related location entities differ between mentions.
 
     Parameters
     ----------
-    ancestors : Dict[str, Dict[str, Any]]
-        A candidate's hierarchical ancestors.
+    candidate : Dict[str, Any]
+        The candidate to get the features for.
     location : Dict[str, Any]
-        The location entity that a distance should be calculated for.
-    locations_data : List[Dict[str, Any]]
-        All location entities in the geoparsing process.
-    text : str
-        The text that the distance should be calculated in.
-    
+        The location entity that the candidate belongs to.
+    mention_index : Dict[str, List[Dict[str, Any]]]
+        All location entities in the geoparsing process, grouped by __build_mention_index().
+    candidate_index : Dict[str, Dict[Tuple[str, ...], List[Tuple[Dict[str, Any], Dict[str, Any]]]]]
+        The candidates of all location entities, grouped by __build_candidate_index().
+    context_features : Dict[Tuple[str, str, Any], Dict[str, Dict[str, Any]]]
+        The features found so far in the document, keyed by entity name, dataset and candidate id.
+    mute_output : bool
+        Mute all text status output.
+
     Returns
     -------
-    Dict[str, int]
-        Dictionary with hierarchical levels as keys (country, admin1, admin2) and their shortest calculated distance as values.
+    Dict[str, Dict[str, Any]]
+        Dictionary with "ancestors", "descendants" and "common_hierarchies" as keys.
+        "ancestors" maps hierarchical levels (country, admin1, admin2) to the names of the location entities that mention the ancestor on that level.
+        "descendants" and "common_hierarchies" map the names of location entities with related candidates to the weight of the relationship.
     """
 
-    hierarchy_distances = {}
-    for key, ancestor in ancestors.items():
-        if ancestor is None:
-            continue
-        for entry in locations_data:
-            if location["entity_name"] == ancestor["name"] or location["entity_name"] == ancestor["asciiname"] or location["entity_name"] in ancestor["alternatenames"]: continue
-            if entry["entity_name"] == ancestor["name"] or entry["entity_name"] == ancestor["asciiname"] or entry["entity_name"] in ancestor["alternatenames"]:
-                distance = __calculate_entity_distance(text, location, entry)
-                if key not in hierarchy_distances: hierarchy_distances[key] = distance
-                elif distance < hierarchy_distances[key]: hierarchy_distances[key] = distance
-    
-    hierarchy_distances_copy = deepcopy(hierarchy_distances)
-    for key, ancestor in hierarchy_distances.items(): # TODO: Remove this as it should no longer be necessary
-        # If the distance is ever 0, it means that a candidate shares the same name with its hierarchical ancestors.
-        # For instance, the entity Trøndelag will return the candidate Trøndelag with feature_code RGN, as being part of the admin1 division Trøndelag.
-        # Calculating the distance for these types of entries will always return 0.
-        # For now we will simply remove these.
-        if ancestor == 0:
-            print("hei") 
-            del hierarchy_distances_copy[key]
-    return hierarchy_distances_copy
+    key = (location["entity_name"], candidate["dataset"], candidate["id"])
+    if key in context_features: return context_features[key]
+
+    ancestor_mentions = {}
+    for level, ancestor in __get_ancestors(candidate, mute_output).items():
+        if ancestor is None: continue
+        if __has_name(location["entity_name"], ancestor): continue
+        names = [name for name in {ancestor["name"], ancestor["asciiname"], *ancestor["alternatenames"]} if name in mention_index]
+        if len(names) != 0: ancestor_mentions[level] = names
+
+    # Every mention of a name is at the same distance from the candidate, so only the highest weight of each name is kept.
+    descendant_mentions = {}
+    for descendant in __find_hierarchical_descendants(candidate, location, candidate_index):
+        if candidate["feature_code"] == "ADM1" and descendant["candidate"]["feature_code"] != "ADM2": weight = 0.25
+        else: weight = 1
+        descendant_mentions[descendant["entity_name"]] = max(weight, descendant_mentions.get(descendant["entity_name"], 0))
+
+    common_hierarchy_mentions = {}
+    common_hierarchies = __find_common_hierarchies(candidate, location, candidate_index)
+    for level, weight in [("admin1", 0.8), ("admin2", 1)]:
+        for common_hierarchy in common_hierarchies[level]:
+            common_hierarchy_mentions[common_hierarchy["entity_name"]] = max(weight, common_hierarchy_mentions.get(common_hierarchy["entity_name"], 0))
+
+    features = {"ancestors": ancestor_mentions, "descendants": descendant_mentions, "common_hierarchies": common_hierarchy_mentions}
+    context_features[key] = features
+    return features
 
 def __rank(
         location: Dict[str, Any],
-        locations_data: List[Dict[str, Any]],
-        es: Elasticsearch,
+        mention_index: Dict[str, List[Dict[str, Any]]],
+        candidate_index: Dict[str, Dict[Tuple[str, ...], List[Tuple[Dict[str, Any], Dict[str, Any]]]]],
+        context_features: Dict[Tuple[str, str, Any], Dict[str, Dict[str, Any]]],
         text: str,
+        word_offsets: np.ndarray,
         inferred_countries: Dict[str, float],
         inferred_adm1: Dict[str, Dict[str, float]],
         mute_output: bool = False,
@@ -814,20 +1361,29 @@ def __rank(
         admin1_weight: float = 1,
         ancestor_weight: float = 1,
         descendant_weight: float = 1,
-        common_hierarchies_weight: float = 1
+        common_hierarchies_weight: float = 1,
+        rank_top_n: Union[int, None] = None,
+        rank_lossless: bool = False
 ) -> None:
     """
     Rank a locations toponym candidates with a value between 0 and 1.
     This value is the 4th-root of the normalized sum of different scoring methods.
+    The number of candidates that are ranked can be limited with rank_top_n, in which case the remaining candidates are removed from the location entry.
 
     Parameters
     ----------
     location : Dict[str, Any]
         The location entry for a given location entity. Contains information such as its name in text, as well as its candidates.
-    locations_data : List[Dict[str, Any]]
-        All location entries generated in the geoparsing process.
-    es : Elasticsearch
-        Elasticsearch instance with the "geonames_custom" index.
+    mention_index : Dict[str, List[Dict[str, Any]]]
+        All location entries generated in the geoparsing process, grouped by __build_mention_index().
+    candidate_index : Dict[str, Dict[Tuple[str, ...], List[Tuple[Dict[str, Any], Dict[str, Any]]]]]
+        The candidates of all location entries, grouped by __build_candidate_index().
+    context_features : Dict[Tuple[str, str, Any], Dict[str, Dict[str, Any]]]
+        The context features of the document, shared between all calls for the same document. See __get_context_features().
+    text : str
+        The text that is being geoparsed.
+    word_offsets : np.ndarray
+        Cumulative word count table for the text, built with __build_word_offsets().
     inferred_countries : Dict[str, float]
         Countries that have been inferred with infer_countries().
     inferred_adm1 : Dict[str, Dict[str, float]]
@@ -848,77 +1404,56 @@ def __rank(
         How much the text mentions of a candidate's geographical descendants should contribute to the overall score.
     common_hierarchies_weight : float
         How much common a candidate's common hierarchies should contribute to the overall score.
+    rank_top_n : Union[int, None]
+        Only rank the rank_top_n candidates with the highest population, alternate names, country and admin1 scores, and remove the rest.
+        Every candidate is ranked if this is None.
+    rank_lossless : bool
+        Also rank the candidates after the first rank_top_n whose score could still be higher than the best score so far, so that the top candidate
+        is the same as without rank_top_n.
     """
 
     if len(location["candidates"]) == 0: return
+
+    # First compute the scores that are cheap to compute for every candidate.
+    cheap_scores = []
     for candidate in location["candidates"]:
-        norm_factor = 1 / (pop_weight + alt_names_weight + country_weight + admin1_weight + ancestor_weight + descendant_weight + common_hierarchies_weight)
-        candidate["pop_score"] = __pop_score(int(candidate["population"]))
-        candidate["alt_names_score"] = __alt_names_score(len(candidate["alternatenames"]))
         candidate["country_score"] = __country_score(inferred_countries, candidate["country_code"])
         candidate["admin1_score"] = __admin1_score(inferred_adm1, candidate["country_code"], candidate["admin1_code"])
-        candidate["ancestor_score"] = __ancestor_score(candidate, es, location, locations_data, text, mute_output)
-        candidate["descendant_score"] = __descendant_score(candidate, location, locations_data, text)
-        candidate["common_hierarchies_score"] = __common_hierarchies_score(candidate, location, locations_data, text)
-        candidate["score"] = \
+        cheap_score = \
                 (candidate["pop_score"] * pop_weight) + \
                 (candidate["alt_names_score"] * alt_names_weight) + \
                 (candidate["country_score"] * country_weight) + \
-                (candidate["admin1_score"] * admin1_weight) + \
+                (candidate["admin1_score"] * admin1_weight)
+        cheap_scores.append((cheap_score, candidate))
+
+    # The scores based on the rest of the text are at most 1 each, which bounds how much a candidate's score can increase.
+    max_context_score = max(ancestor_weight, 0) + max(descendant_weight, 0) + max(common_hierarchies_weight, 0)
+    if rank_top_n is not None: cheap_scores.sort(key=lambda cheap: cheap[0], reverse=True)
+    norm_factor = 1 / (pop_weight + alt_names_weight + country_weight + admin1_weight + ancestor_weight + descendant_weight + common_hierarchies_weight)
+    best_score = None
+    ranked_candidates = []
+    for i, (cheap_score, candidate) in enumerate(cheap_scores):
+        if rank_top_n is not None and i >= rank_top_n:
+            if not rank_lossless: break
+            # The remaining candidates have even lower cheap scores, so once one of them can not be ranked first, none of them can.
+            if best_score is not None and cheap_score + max_context_score < best_score: break
+
+        features = __get_context_features(candidate, location, mention_index, candidate_index, context_features, mute_output)
+        candidate["ancestor_score"] = __ancestor_score(features, location, mention_index, text, word_offsets)
+        candidate["descendant_score"] = __descendant_score(features, location, mention_index, text, word_offsets)
+        candidate["common_hierarchies_score"] = __common_hierarchies_score(features, location, mention_index, text, word_offsets)
+        score = cheap_score + \
                 (candidate["ancestor_score"] * ancestor_weight) + \
                 (candidate["descendant_score"] * descendant_weight) + \
                 (candidate["common_hierarchies_score"] * common_hierarchies_weight) 
+        if best_score is None or score > best_score: best_score = score
                 
-        candidate["score"] = (candidate["score"] * norm_factor)**(1/4)
-        __find_common_hierarchies(candidate, location, locations_data)
+        candidate["score"] = (score * norm_factor)**(1/4)
+        ranked_candidates.append(candidate)
 
     def sort(candidate):
         return candidate["score"]
-    location["candidates"] = sorted(location["candidates"], key=sort, reverse=True)
-
-def __pop_score(
-        candidate_pop: int
-) -> float:
-    """
-    Calculate the population score for a candidate.
-    Uses a logistic function to produce an output.
-    The population size is scaled to better fit with the logistic function.
-
-    Parameters
-    ----------
-    candidate_pop : int
-        The population size of a candidate.
-    
-    Returns
-    -------
-    float
-        The score given a population size.
-    """
-
-    if candidate_pop == 0: return 0
-    scaled_pop = candidate_pop / 10000
-    return logistic_function(log2(scaled_pop), 3)
-
-def __alt_names_score(
-        num_alt_names: int
-) -> float:
-    """
-    Calculate the alternate names score for a candidate.
-    Uses a logistic function to produce an output.
-
-    Parameters
-    ----------
-    num_alt_names : int
-        The number of alternate names for a candidate.
-    
-    Returns
-    -------
-    float
-        The score given the number of alternate names.
-    """
-
-    if num_alt_names == 0: return 0
-    return logistic_function(log2(num_alt_names), 3)
+    location["candidates"] = sorted(ranked_candidates, key=sort, reverse=True)
 
 def __country_score(
         inferred_countries: Dict[str, float],
@@ -971,12 +1506,11 @@ def __admin1_score(
     return inferred_adm1[country_code][admin1_code]
 
 def __ancestor_score(
-        candidate: Dict[str, Any],
-        es: Elasticsearch,
+        features: Dict[str, Dict[str, Any]],
         location: Dict[str, Any],
-        locations_data: List[Dict[str, Any]],
+        mention_index: Dict[str, List[Dict[str, Any]]],
         text: str,
-        mute_output: bool = False
+        word_offsets: np.ndarray
 ) -> float:
     """
     Calculate the score a candidate should receive based on how close its hierarchical ancestors are in text.
@@ -984,18 +1518,16 @@ def __ancestor_score(
 
     Parameters
     ----------
-    candidate : Dict[str, Any]
-        The candidate to score.
-    es : Elasticsearch
-        Elasticsearch instance. Must have the "geonames_custom" index.
+    features : Dict[str, Dict[str, Any]]
+        The context features of the candidate, from __get_context_features().
     location : Dict[str, Any]
         The location entity that the candidate belongs to.
-    locations_data : List[Dict[str, Any]]
-        All location entities in the geoparsing process.
+    mention_index : Dict[str, List[Dict[str, Any]]]
+        All location entities in the geoparsing process, grouped by __build_mention_index().
     text : str
         The text that is being geoparsed.
-    mute_output : bool
-        Mute all text status output.
+    word_offsets : np.ndarray
+        Cumulative word count table for the text, built with __build_word_offsets().
         
     Returns
     -------
@@ -1003,10 +1535,12 @@ def __ancestor_score(
         The score a candidate should receive based on its distance to hierarchical ancestors.
     """
 
-    ancestors = __get_ancestors(candidate, es, mute_output)
-    hierarchy_distances = __find_ancestor_distances(ancestors, location, locations_data, text)
     score = 0
-    for key, value in hierarchy_distances.items():
+    for key, names in features["ancestors"].items():
+        value = min(__find_nearest_mention_distance(text, word_offsets, location, mention_index[name]) for name in names)
+        # If the distance is 0, the candidate shares the same name with its hierarchical ancestor.
+        # For instance, the entity Trøndelag will return the candidate Trøndelag with feature_code RGN, as being part of the admin1 division Trøndelag.
+        if value == 0: continue
         temp_score = 0
         if key == "admin2": temp_score = (1 / log2(value+1))
         if key == "admin1": temp_score = (1 / log2(value+1)) * 0.5
@@ -1015,10 +1549,11 @@ def __ancestor_score(
     return score
 
 def __descendant_score(
-        candidate: Dict[str, Any],
+        features: Dict[str, Dict[str, Any]],
         location: Dict[str, Any],
-        locations_data: List[Dict[str, Any]],
-        text: str
+        mention_index: Dict[str, List[Dict[str, Any]]],
+        text: str,
+        word_offsets: np.ndarray
 ) -> float:
     """
     Calculate the score a candidate should receive based on how close its hierarchical descendants are in text.
@@ -1026,14 +1561,16 @@ def __descendant_score(
 
     Parameters
     ----------
-    candidate : Dict[str, Any]
-        The candidate to score.
+    features : Dict[str, Dict[str, Any]]
+        The context features of the candidate, from __get_context_features().
     location : Dict[str, Any]
         The location entity that the candidate belongs to.
-    locations_data : List[Dict[str, Any]]
-        All location entities in the geoparsing process.
+    mention_index : Dict[str, List[Dict[str, Any]]]
+        All location entities in the geoparsing process, grouped by __build_mention_index().
     text : str
         The text that is being geoparsed.
+    word_offsets : np.ndarray
+        Cumulative word count table for the text, built with __build_word_offsets().
         
     Returns
     -------
@@ -1041,23 +1578,20 @@ def __descendant_score(
         The score a candidate should receive based on its distance to hierarchical descendants.
     """
 
-    hierarchical_descendants = __find_hierarchical_descendants(candidate, location, locations_data)
     score = 0
-    for descendant in hierarchical_descendants:
-        distance = __calculate_entity_distance(text, descendant, location)
+    for entity_name, weight in features["descendants"].items():
+        distance = __find_nearest_mention_distance(text, word_offsets, location, mention_index[entity_name])
         if distance == 0: continue # This should in theory never happen.
-        if candidate["feature_code"] == "ADM1" and descendant["candidate"]["feature_code"] != "ADM2":
-            temp_score = (1 / log2(distance+1)) * 0.25
-        else:
-            temp_score = (1 / log2(distance+1))
+        temp_score = (1 / log2(distance+1)) * weight
         if temp_score > score: score = temp_score
     return score
 
 def __common_hierarchies_score(
-        candidate: Dict[str, Any],
+        features: Dict[str, Dict[str, Any]],
         location: Dict[str, Any],
-        locations_data: List[Dict[str, Any]],
-        text: str
+        mention_index: Dict[str, List[Dict[str, Any]]],
+        text: str,
+        word_offsets: np.ndarray
 ) -> float:
     """
     Calculate the score a candidate should receive based on how close common hierarchical toponyms are in the text.
@@ -1065,14 +1599,16 @@ def __common_hierarchies_score(
 
     Parameters
     ----------
-    candidate : Dict[str, Any]
-        The candidate to score.
+    features : Dict[str, Dict[str, Any]]
+        The context features of the candidate, from __get_context_features().
     location : Dict[str, Any]
         The location entity that the candidate belongs to.
-    locations_data : List[Dict[str, Any]]
-        All location entities in the geoparsing process.
+    mention_index : Dict[str, List[Dict[str, Any]]]
+        All location entities in the geoparsing process, grouped by __build_mention_index().
     text : str
         The text that is being geoparsed.
+    word_offsets : np.ndarray
+        Cumulative word count table for the text, built with __build_word_offsets().
         
     Returns
     -------
@@ -1080,16 +1616,10 @@ def __common_hierarchies_score(
         The score a candidate should receive based on its distance to common hierarchical toponyms.
     """
 
-    common_hierarchies = __find_common_hierarchies(candidate, location, locations_data)
     score = 0
-    for common_admin1_hierarchy in common_hierarchies["admin1"]:
-        distance = __calculate_entity_distance(text, common_admin1_hierarchy, location)
+    for entity_name, weight in features["common_hierarchies"].items():
+        distance = __find_nearest_mention_distance(text, word_offsets, location, mention_index[entity_name])
         if distance == 0: continue # This should in theory never happen.
-        temp_score = (1 / log2(distance+1)) * 0.8
+        temp_score = (1 / log2(distance+1)) * weight
         if temp_score > score: score = temp_score
-    for common_admin2_hierarchy in common_hierarchies["admin2"]:
-        distance = __calculate_entity_distance(text, common_admin2_hierarchy, location)
-        if distance == 0: continue # This should in theory never happen.
-        temp_score = (1 / log2(distance+1))
-        if temp_score > score: score = temp_score
-    return score
\ No newline at end of file
+    return score
@@ -1,9 +1,23 @@
+import json
+import os
 import PyPDF2
 import numpy as np
 import pytesseract
-from pdf2image import convert_from_path
+from functools import partial
+from hashlib import sha1
+from multiprocessing import Pool
+from typing import Any, Callable, Dict, Iterator, List, Tuple, Union
+from pdf2image import convert_from_path, pdfinfo_from_path
+from PIL.Image import Image
+from cache import DiskCache
 from utility import deskew
 
+# Persistent cache of the text read from each page, enabled with enable_pdf_cache() in the geoparser. Nothing is cached if this is None.
+# Pages are keyed by the content of the file, so the cache is still used if a file is moved, and not if it is changed.
+PAGE_CACHE: Union[DiskCache, None] = None
+
+# Content hashes of the files read so far, keyed by path, modification time and size, so that each file is only hashed once.
+FILE_HASHES: Dict[Tuple[str, float, int], str] = {}
 
 def pypdf2_parse(
         file_path: str,
@@ -27,9 +41,9 @@ def pypdf2_parse(
 
     with open(file_path, "rb") as file:
         pdfReader = PyPDF2.PdfReader(file, strict=True)
-        text = ""
-        for page in pdfReader.pages:
-            text += page.extract_text() + "\n\n"
+        page_texts = __cached_pages(file_path, list(range(1, len(pdfReader.pages) + 1)), {"parser": "pypdf2"},
+                                    lambda page_numbers: [pdfReader.pages[page_number - 1].extract_text() for page_number in page_numbers])
+        text = "".join(page_text + "\n\n" for page_text in page_texts)
 
         if is_wikipedia:
             # TODO: Potential extra logic for wikipedia articles.
@@ -39,10 +53,16 @@ def pypdf2_parse(
 
 def ocr_parse(
         file_path: str,
-        is_wikipedia: bool
+        is_wikipedia: bool,
+        workers: Union[int, None] = None,
+        window_size: Union[int, None] = None,
+        lang: str = "nor",
+        deskew_pages: bool = True
 ) -> str:
     """
     Parse a pdf file using the pytesseract library.
+    The pages are read in parallel by a pool of worker processes.
+    Only a few pages are rendered at a time, so memory use does not depend on the length of the file.
 
     Parameters
     ----------
@@ -50,6 +70,15 @@ def ocr_parse(
         Path to a pdf file.
     is_wikipedia : bool
         Is the pdf file a wikipedia article.
+    workers : Union[int, None]
+        Number of worker processes. Uses the number of CPUs if None.
+    window_size : Union[int, None]
+        Number of pages rendered at a time. The next pages are rendered while the current ones are read, so up to twice as many pages can be in memory.
+        Uses twice the number of workers if None.
+    lang : str
+        The language pytesseract should read the pages in.
+    deskew_pages : bool
+        Whether pages should be deskewed before they are read.
 
     Returns
     -------
@@ -57,17 +86,264 @@ def ocr_parse(
         The pdf file parsed into a single string.
     """
 
-    pages = convert_from_path(file_path)
-    text = ""
-    for page in pages:
-        text += pytesseract.image_to_string(deskew(np.array(page)), lang="nor")
+    page_count = pdfinfo_from_path(file_path)["Pages"]
+    page_texts = __cached_pages(file_path, list(range(1, page_count + 1)), {"parser": "ocr", "lang": lang, "deskew": deskew_pages},
+                                lambda page_numbers: __ocr_pages(file_path, page_numbers, workers, window_size, lang, deskew_pages))
+    text = "".join(page_texts)
 
     # Some custom logic to help with wikipedia articles 
-    if is_wikipedia:
-        text_split = text.split("\n")
-        for i, line in enumerate(text_split):
-            # This can lead to mistakes if these strings are in an article without being in the footer.
-            if line == "Litteratur" or line == "Referanser" or line == "Eksterne lenker":
-                text = "\n".join(text_split[:i])
-                break
-    return text.strip()
\ No newline at end of file
+    if is_wikipedia: text = __remove_wikipedia_footer(text)
+    return text.strip()
+
+def hybrid_parse(
+        file_path: str,
+        is_wikipedia: bool,
+        min_chars: int = 100,
+        workers: Union[int, None] = None,
+        window_size: Union[int, None] = None,
+        lang: str = "nor",
+        deskew_pages: bool = True
+) -> str:
+    """
+    Parse a pdf file using the text layer read by the PyPDF2 library where there is one, and the pytesseract library for the remaining pages.
+    Useful for files that mix born-digital and scanned pages, as only the scanned pages have to be read with OCR.
+
+    Parameters
+    ----------
+    file_path : str
+        Path to a pdf file.
+    is_wikipedia : bool
+        Is the pdf file a wikipedia article.
+    min_chars : int
+        Pages with fewer characters than this in their text layer, not counting whitespace, are read with OCR instead.
+    workers : Union[int, None]
+        Number of worker processes used for OCR. Uses the number of CPUs if None.
+    window_size : Union[int, None]
+        Number of pages rendered for OCR at a time, see ocr_parse().
+    lang : str
+        The language pytesseract should read the pages in.
+    deskew_pages : bool
+        Whether pages should be deskewed before they are read with OCR.
+
+    Returns
+    -------
+    str
+        The pdf file parsed into a single string.
+    """
+
+    with open(file_path, "rb") as file:
+        pdfReader = PyPDF2.PdfReader(file, strict=True)
+        page_texts = __cached_pages(file_path, list(range(1, len(pdfReader.pages) + 1)), {"parser": "pypdf2"},
+                                    lambda page_numbers: [pdfReader.pages[page_number - 1].extract_text() for page_number in page_numbers])
+
+    # The pages read with OCR are cached in the same way as in ocr_parse(), so the two parsers share them.
+    ocr_page_numbers = [i + 1 for i, page_text in enumerate(page_texts) if len("".join(page_text.split())) < min_chars]
+    if len(ocr_page_numbers) != 0:
+        ocr_page_texts = __cached_pages(file_path, ocr_page_numbers, {"parser": "ocr", "lang": lang, "deskew": deskew_pages},
+                                        lambda page_numbers: __ocr_pages(file_path, page_numbers, workers, window_size, lang, deskew_pages))
+        for page_number, page_text in zip(ocr_page_numbers, ocr_page_texts):
+            page_texts[page_number - 1] = page_text
+    text = "\n\n".join(page_text.strip() for page_text in page_texts)
+
+    if is_wikipedia: text = __remove_wikipedia_footer(text)
+    return text.strip()
+
+def __remove_wikipedia_footer(
+        text: str
+) -> str:
+    """
+    Remove the reference sections at the end of a wikipedia article.
+
+    Parameters
+    ----------
+    text : str
+        Text of a wikipedia article.
+
+    Returns
+    -------
+    str
+        The text up to the first reference section.
+    """
+
+    text_split = text.split("\n")
+    for i, line in enumerate(text_split):
+        # This can lead to mistakes if these strings are in an article without being in the footer.
+        if line == "Litteratur" or line == "Referanser" or line == "Eksterne lenker":
+            return "\n".join(text_split[:i])
+    return text
+
+def __ocr_pages(
+        file_path: str,
+        page_numbers: List[int],
+        workers: Union[int, None] = None,
+        window_size: Union[int, None] = None,
+        lang: str = "nor",
+        deskew_pages: bool = True
+) -> List[str]:
+    """
+    Read the given pages of a pdf file with pytesseract, using a pool of worker processes.
+
+    Parameters
+    ----------
+    file_path : str
+        Path to a pdf file.
+    page_numbers : List[int]
+        The pages to read, counting from 1.
+    workers : Union[int, None]
+        Number of worker processes. Uses the number of CPUs if None.
+    window_size : Union[int, None]
+        Number of pages rendered at a time. Uses twice the number of workers if None.
+    lang : str
+        The language pytesseract should read the pages in.
+    deskew_pages : bool
+        Whether pages should be deskewed before they are read.
+
+    Returns
+    -------
+    List[str]
+        The text of each page, in the same order as page_numbers.
+    """
+
+    if workers is None: workers = os.cpu_count() or 1
+    if window_size is None: window_size = 2 * workers
+    ocr_page = partial(__ocr_page, lang=lang, deskew_pages=deskew_pages)
+    page_texts = []
+    if workers == 1 or len(page_numbers) <= 1:
+        for pages in __render_windows(file_path, page_numbers, window_size):
+            page_texts.extend(ocr_page(page) for page in pages)
+        return page_texts
+
+    with Pool(min(workers, len(page_numbers))) as pool:
+        pending = None
+        for pages in __render_windows(file_path, page_numbers, window_size):
+            if pending is not None: page_texts.extend(pending.get())
+            # map_async keeps the pages in order, and lets the next window be rendered while this one is read.
+            pending = pool.map_async(ocr_page, pages, chunksize=1)
+        if pending is not None: page_texts.extend(pending.get())
+    return page_texts
+
+def __render_windows(
+        file_path: str,
+        page_numbers: List[int],
+        window_size: int
+) -> Iterator[List[Image]]:
+    """
+    Render the given pages of a pdf file a few at a time.
+
+    Parameters
+    ----------
+    file_path : str
+        Path to a pdf file.
+    page_numbers : List[int]
+        The pages to render, counting from 1.
+    window_size : int
+        Number of pages to render at a time.
+
+    Returns
+    -------
+    Iterator[List[Image]]
+        The rendered pages, in lists of up to window_size pages.
+    """
+
+    for i in range(0, len(page_numbers), window_size):
+        window = page_numbers[i:i + window_size]
+        pages = []
+        # Consecutive pages are rendered together.
+        run_start = 0
+        for j in range(1, len(window) + 1):
+            if j == len(window) or window[j] != window[j - 1] + 1:
+                pages.extend(convert_from_path(file_path, first_page=window[run_start], last_page=window[j - 1]))
+                run_start = j
+        yield pages
+
+def __ocr_page(
+        page: Image,
+        lang: str = "nor",
+        deskew_pages: bool = True
+) -> str:
+    """
+    Deskew a single page and read its text with pytesseract.
+
+    Parameters
+    ----------
+    page : Image
+        The page, as rendered by pdf2image.
+    lang : str
+        The language pytesseract should read the page in.
+    deskew_pages : bool
+        Whether the page should be deskewed before it is read.
+
+    Returns
+    -------
+    str
+        The text of the page.
+    """
+
+    page = np.array(page)
+    if deskew_pages: page, _ = deskew(page)
+    return pytesseract.image_to_string(page, lang=lang)
+
+def __cached_pages(
+        file_path: str,
+        page_numbers: List[int],
+        settings: Dict[str, Any],
+        read_pages: Callable[[List[int]], List[str]]
+) -> List[str]:
+    """
+    Get the text of the given pages of a pdf file from PAGE_CACHE, and only read the pages that are not in it.
+    Pages are keyed by the content hash of the file, the page number, and the settings they were read with.
+
+    Parameters
+    ----------
+    file_path : str
+        Path to a pdf file.
+    page_numbers : List[int]
+        The pages to get, counting from 1.
+    settings : Dict[str, Any]
+        The parser and its settings. Pages read with different settings are cached separately.
+    read_pages : Callable[[List[int]], List[str]]
+        Reads the text of a list of pages, in the same order as the list.
+
+    Returns
+    -------
+    List[str]
+        The text of each page, in the same order as page_numbers.
+    """
+
+    if PAGE_CACHE is None: return read_pages(page_numbers)
+
+    file_hash = __file_hash(file_path)
+    cache_keys = {page_number: sha1(json.dumps([file_hash, page_number, settings], sort_keys=True).encode("utf-8")).hexdigest() for page_number in page_numbers}
+    cached_pages = PAGE_CACHE.get_many(list(cache_keys.values()))
+    missing_page_numbers = [page_number for page_number in page_numbers if cache_keys[page_number] not in cached_pages]
+    if len(missing_page_numbers) != 0:
+        read_texts = dict(zip(missing_page_numbers, read_pages(missing_page_numbers)))
+        PAGE_CACHE.set_many({cache_keys[page_number]: page_text for page_number, page_text in read_texts.items()})
+        cached_pages.update({cache_keys[page_number]: page_text for page_number, page_text in read_texts.items()})
+    return [cached_pages[cache_keys[page_number]] for page_number in page_numbers]
+
+def __file_hash(
+        file_path: str
+) -> str:
+    """
+    SHA-1 hash of the content of a file. The hash is only computed once for each version of a file.
+
+    Parameters
+    ----------
+    file_path : str
+        Path to the file.
+
+    Returns
+    -------
+    str
+        The hash as a hexadecimal string.
+    """
+
+    stamp = (os.path.abspath(file_path), os.path.getmtime(file_path), os.path.getsize(file_path))
+    if stamp not in FILE_HASHES:
+        file_hash = sha1()
+        with open(file_path, "rb") as file:
+            for chunk in iter(lambda: file.read(1024**2), b""):
+                file_hash.update(chunk)
+        FILE_HASHES[stamp] = file_hash.hexdigest()
+    return FILE_HASHES[stamp]
@@ -1,9 +1,8 @@
 import cv2
 import numpy as np
 import pandas as pd
-from typing import Any, List, Dict, Union
-from math import exp
-from unidecode import unidecode
+from typing import Any, List, Dict, Tuple, Union
+from features import geonames_features
 from lists import *
 from tabulate import tabulate
 import geopy.distance
@@ -36,37 +35,52 @@ def create_solutions_dict(
 
 # Deskew image for ocr parse.
 def deskew(
-        pdf : np.ndarray
-) -> cv2.typing.MatLike:
+        pdf : np.ndarray,
+        angle_tolerance: float = 0.5,
+        max_size: int = 1000
+) -> Tuple[cv2.typing.MatLike, float]:
     """
-    Deskew a pdf, so that it can be used with pytesseract
+    Deskew a pdf, so that it can be used with pytesseract.
+    The skew angle is estimated on a thresholded copy of the page that is scaled down to at most max_size pixels on each side.
 
     Parameters
     ----------
     pdf : np.NDArray[Any]
         pdf as a numpy array.
+    angle_tolerance : float
+        Pages that are skewed by less than this many degrees are not rotated.
+    max_size : int
+        The largest width or height of the copy the angle is estimated on.
         
     Returns
     -------
-    Dict[str, Dict[str, Any]]
-        A deskewed representation of the pdf.  
+    Tuple[cv2.typing.MatLike, float]
+        A deskewed representation of the pdf, and the angle in degrees it was rotated by. The angle is 0 if it was not rotated.
     """
 
     gray = cv2.cvtColor(pdf, cv2.COLOR_BGR2GRAY)
     gray = cv2.bitwise_not(gray)
-    coords = np.column_stack(np.where(gray > 0))
+    scale = max_size / max(gray.shape)
+    if scale < 1: gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    _, thresh = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+    coords = np.column_stack(np.where(thresh > 0))
+    if len(coords) == 0: return pdf, 0.0
     angle = cv2.minAreaRect(coords)[-1]
-    
+
+    # The angle of the rectangle is only defined up to multiples of 90 degrees, and its range differs between OpenCV versions.
     if angle < -45:
         angle = -(90 + angle)
+    elif angle >= 45:
+        angle = 90 - angle
     else:
         angle = -angle
+    if abs(angle) < angle_tolerance: return pdf, 0.0
 
     (h, w) = pdf.shape[:2]
     center = (w // 2, h // 2)
     M = cv2.getRotationMatrix2D(center, angle, 1.0)
     rotated = cv2.warpAffine(pdf, M, (w, h), flags=cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE)
-    return rotated
+    return rotated, angle
 
 def read_admin1(
         file_path: str
@@ -133,34 +147,6 @@ def write_csv_results(
                 continue
             file.write(f"\"{top_candidate['name']}\",{top_candidate['id']},\"{top_candidate['coordinates']}\",{top_candidate['dataset']}\n")
 
-def logistic_function(
-        x: float,
-        x0: float = 0,
-        l: float = 1,
-        k: float = 1
-) -> float:
-    """
-    Calculate the value of a logistic function with the given input parameters.
-
-    Parameters
-    ----------
-    x : float
-        The value to calculate for.
-    x0 : float
-        x0 is the x value of the function's midpoint.
-    l : float
-        The carrying capacity of the values of the function.
-    k : float
-        The growth rate of the function.
-        
-    Returns
-    -------
-    float
-        The calculated value.
-    """
-
-    return l / (1 + exp(-k*(x-x0)))
-
 def print_results(
         results: List[Dict[str, Any]],
         fields: List[str] = ["entity_name"],
@@ -259,6 +245,13 @@ def print_all_mappings(
     print(tabulate(tabulate_list, headers=["Location Mention", "Toponym ID", "Toponym Dataset", "Entity Name", 
                             "Candidate Name", "Candidate ID", "Candidate Dataset", "Distance (km)"]))
 
+# The fields of the indexed entries that are used by convert_geonames() and convert_stedsnavn().
+# Gazetteer queries only request these fields, so that no unused data is transferred.
+GEONAMES_FIELDS = ["geonameid", "name", "asciiname", "alternatenames", "coordinates", "feature_code", "country_code", "admin1_code", "admin2_code",
+                   "population", "pop_score", "alt_names_count", "alt_names_score"]
+STEDSNAVN_FIELDS = ["stedsnavnid", "name", "asciiname", "alternatenames", "coordinates", "name_object_type", "admin1_code", "admin2_code",
+                    "pop_score", "alt_names_count", "alt_names_score"]
+
 def convert_geonames(
         geonames_entry: Dict[str, Any]
 ) -> Dict[str, Any]:
@@ -276,6 +269,8 @@ def convert_geonames(
         A dictionary which encapsulates the GeoNames entry with the information needed in the geoparser.
     """
 
+    # Entries indexed before the ranking features were stored on them get them computed here instead.
+    features = geonames_entry if "pop_score" in geonames_entry else geonames_features(geonames_entry)
     return {"dataset": "geonames", 
             "id": geonames_entry["geonameid"], 
             "name": geonames_entry["name"], 
@@ -286,14 +281,11 @@ def convert_geonames(
             "country_code": geonames_entry["country_code"],
             "admin1_code": geonames_entry["admin1_code"],
             "admin2_code": geonames_entry["admin2_code"],
-            "population": geonames_entry["population"]}
-
-# TODO: Stedsnavn entries can be part of multiple administrative divisions. Should augment the algorithm so that it can handle multiple entries.
-# For now we simply use the first entry administrative divisions.
-# TODO: We are currently using the ADMIN1_MAP and ADMIN2_MAP dictionaries to convert stedsnavn entry codes into geonames ones.
-# This is because the geonames index and accompanying admin code files still use outdated admin codes.
-# In the future, geonames will probably update its info, at which point these maps will be unnecessary.
-# https://www.kartverket.no/til-lands/fakta-om-norge/norske-fylke-og-kommunar
+            "population": geonames_entry["population"],
+            "pop_score": features["pop_score"],
+            "alt_names_count": features["alt_names_count"],
+            "alt_names_score": features["alt_names_score"]}
+
 # TODO: Apparently Stedsnavn also has nation entries, in which case all of this makes no sense.
 # Either need to fix or make sure these entries are not indexed.
 # Should not be an issue for the geoparser as it will always find nation candidates from geonames.
@@ -302,6 +294,7 @@ def convert_stedsnavn(
 ) -> Dict[str, Any]:
     """
     Convert a Stedsnavn index entry into one that is usable in the geoparser.
+    The ascii name and GeoNames admin codes are computed by the indexer, see stedsnavn_features().
 
     Parameters
     ----------
@@ -317,16 +310,17 @@ def convert_stedsnavn(
     return {"dataset": "stedsnavn", 
             "id": stedsnavn_entry["stedsnavnid"], 
             "name": stedsnavn_entry["name"], 
-            "asciiname": unidecode(stedsnavn_entry["name"]),
+            "asciiname": stedsnavn_entry["asciiname"],
             "alternatenames": stedsnavn_entry["alternatenames"],
             "coordinates": stedsnavn_entry["coordinates"],
             "feature_code": stedsnavn_entry["name_object_type"], # Not really a code for Stedsnavn, but will use the same name anyways
             "country_code": "NO",
-            "admin1_code": ADMIN1_MAP[stedsnavn_entry["admin_codes"][0][0]], 
-            "admin2_code": ADMIN2_MAP[stedsnavn_entry["admin_codes"][0][1]],
-            # "admin1_code": stedsnavn_entry["admin_codes"][0][0],
-            # "admin2_code": stedsnavn_entry["admin_codes"][0][1],
-            "population": "0"} # Stedsnavn has no population data
+            "admin1_code": stedsnavn_entry["admin1_code"], 
+            "admin2_code": stedsnavn_entry["admin2_code"],
+            "population": "0", # Stedsnavn has no population data
+            "pop_score": stedsnavn_entry["pop_score"],
+            "alt_names_count": stedsnavn_entry["alt_names_count"],
+            "alt_names_score": stedsnavn_entry["alt_names_score"]}
 
 def get_top_candidate(
         location: Dict[str, Any]